@@ -1,6 +1,13 @@
 from random import randint, shuffle
-from copy import copy, deepcopy
 from time import time
+from threading import Thread, Event
+import endgame
+import book
+
+# Score given to a won game, above any score the evaluation can give
+win_score = 1000000
+# Deepest that a search will ever go
+max_search_depth = 64
 
 class TreeNode:
     def __init__(self, element):
@@ -39,6 +46,131 @@ class TreeNode:
         # No children contain it so no match
         return False
 
+"""
+A fixed-size table of search results, keyed by the board's position hash.
+Each entry is a tuple (hash, depth, score, flag, move, generation), where flag
+says whether the score is exact or only a bound found by an alpha-beta cutoff.
+Every bucket has two slots: one keeps the deepest result for that bucket and
+the other always takes the newest, so deep results survive a flood of shallow
+ones but are replaced once they are left over from an earlier turn.
+"""
+class TranspositionTable:
+    # Kinds of scores that can be stored
+    EXACT = 0
+    LOWER = 1 # The real score is at least this much
+    UPPER = 2 # The real score is at most this much
+
+    def __init__(self, size=1 << 16):
+        # Number of buckets
+        self.size = size
+        # Slot keeping the deepest result and slot keeping the newest result.
+        # These are only made when the first search starts, so an AI that
+        # never searches does not pay for them.
+        self.deep = None
+        self.recent = None
+        # Search the table is being used for, to tell old entries apart
+        self.generation = 0
+        # Lookups that found and did not find their position
+        self.hits = 0
+        self.misses = 0
+
+    """
+    Start a new search, so that entries from earlier ones can be replaced.
+    """
+    def new_search(self):
+        if self.deep == None:
+            self.clear()
+        self.generation += 1
+
+    """
+    Find the entry for a position hash, or None if it is not in the table.
+    """
+    def lookup(self, key):
+        entry = self.find(key)
+        if entry != None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return entry
+
+    # Like lookup, but without counting it as a hit or a miss, for looking
+    # again at a position that has already been looked up
+    def find(self, key):
+        bucket = key % self.size
+        entry = self.deep[bucket]
+        if entry != None and entry[0] == key:
+            return entry
+        entry = self.recent[bucket]
+        if entry != None and entry[0] == key:
+            return entry
+        return None
+
+    """
+    Store the result of searching a position to the given depth.
+    """
+    def store(self, key, depth, score, flag, move):
+        bucket = key % self.size
+        entry = (key, depth, score, flag, move, self.generation)
+        deep = self.deep[bucket]
+        # Take the deep slot if it is empty, holds this position, is shallower
+        # or is left over from an earlier search
+        if deep == None or deep[0] == key or depth >= deep[1] or\
+                deep[5] != self.generation:
+            # Keep what was there in the other slot if it is another position
+            if deep != None and deep[0] != key:
+                self.recent[bucket] = deep
+            self.deep[bucket] = entry
+        else:
+            self.recent[bucket] = entry
+
+    """
+    Empty the table.
+    """
+    def clear(self):
+        self.deep = [None] * self.size
+        self.recent = [None] * self.size
+        self.hits = 0
+        self.misses = 0
+
+"""
+A move an AI is working out in the background (see AI.think). The result is
+the move as ((source x, source y), (destination x, destination y)), the way
+the board keeps it in its move history, or None if no move was made.
+"""
+class MoveFuture:
+    def __init__(self, board, timed=True):
+        # Copy of the board the AI is searching on
+        self.board = board
+        # Whether the search stops when the AI's max_time is up, rather than
+        # only when cancelled
+        self.timed = timed
+        self.move = None
+        self.error = None
+        # Whether the AI passed its turn, having no move to make
+        self.passed = False
+        # Whether the search has been asked to stop
+        self.cancelled = False
+        self.finished = Event()
+
+    # Ask the search to stop as soon as it can and give no move
+    def cancel(self):
+        self.cancelled = True
+
+    # Whether the AI has finished (or given up)
+    def done(self):
+        return self.finished.is_set()
+
+    """
+    Wait for the AI to finish, for at most timeout seconds if given, and
+    return its move (None if there is none yet). An error in the AI is raised
+    here.
+    """
+    def result(self, timeout=None):
+        self.finished.wait(timeout)
+        if self.error != None:
+            raise self.error
+        return self.move
+
 class AI:
     def __init__(self, difficulty):
         # List of available AIs
@@ -46,7 +178,8 @@ class AI:
                 self.random_ai,
                 self.directional_slide_ai,
                 self.naive_maximizer_ai,
-                self.best_score ]
+                self.best_score,
+                self.alpha_beta_ai ]
         # Select an AI to use based on dificulty setting
         self.ai_player = self.ai_list[difficulty]
         # A set direction that the AI should move in
@@ -55,32 +188,161 @@ class AI:
         self.max_time = 1
         # Time that a move search started
         self.search_start = 0
+        # Results of earlier searches, kept between turns of the game
+        self.table = TranspositionTable()
+        # Positions looked at by the current search
+        self.nodes = 0
+        # Whether the current search has run out of time
+        self.out_of_time = False
+        # Depth of the last search that was finished
+        self.depth_reached = 0
+        # Moves that caused a cutoff, by how many moves into the search
+        self.killers = {}
+        # How much each (source, destination) move has caused cutoffs
+        self.history = {}
+        # Where to look for endgame tables and the opening book
+        # (None for the default place)
+        self.endgame_directory = None
+        self.book_directory = None
+        # Move being worked out in the background, if any (see think), and
+        # what to tell about how the search is going
+        self.future = None
+        self.on_progress = None
+        # Whether to search while the opponent is thinking (see ponder_on),
+        # and the best moves found that way, by position hash, as
+        # ((source index, destination index), depth searched)
+        self.ponder = False
+        self.ponder_cache = {}
+
+    """
+    Work out a move in a background thread, on a copy of the board so the
+    board itself can still be drawn and is only changed by whoever plays the
+    move. Returns a MoveFuture. If given, on_progress(depth, nodes, seconds,
+    move) is called from the thread every time a deeper search finishes.
+    """
+    def think(self, board, on_progress=None):
+        future = MoveFuture(board.snapshot())
+        def work(snapshot):
+            made = len(snapshot.moves)
+            turn = snapshot.curPlayer
+            self.ai_player(snapshot)
+            if future.cancelled:
+                return
+            if len(snapshot.moves) > made:
+                future.move = snapshot.moves[made]
+            elif snapshot.curPlayer != turn:
+                future.passed = True
+        self.start_worker(future, work, on_progress)
+        return future
+
+    """
+    Search the replies to the opponent's possible moves in a background
+    thread while the opponent is thinking, keeping the best move for each in
+    ponder_cache (and everything else in the transposition table) for when
+    the real move arrives. Only the alpha-beta AI ponders, and only if ponder
+    is turned on; otherwise this returns None. The search goes on until the
+    returned MoveFuture is cancelled, which must be done before the AI is
+    asked for a move.
+    """
+    def ponder_on(self, board):
+        if not self.ponder or self.ai_player != self.alpha_beta_ai:
+            return None
+        future = MoveFuture(board.snapshot(), False)
+        self.start_worker(future, self.ponder_replies)
+        return future
+
+    # Run job(snapshot) in a daemon thread for a MoveFuture
+    def start_worker(self, future, job, on_progress=None):
+        def work():
+            self.future = future
+            self.on_progress = on_progress
+            try:
+                job(future.board)
+            except Exception as e:
+                future.error = e
+            self.future = None
+            self.on_progress = None
+            future.finished.set()
+        thread = Thread(target = work)
+        thread.daemon = True
+        thread.start()
+
+    # Whether a search should stop: its time is up or it has been cancelled
+    def should_stop(self):
+        if self.future != None:
+            if self.future.cancelled:
+                return True
+            if not self.future.timed:
+                return False
+        return time() - self.search_start >= self.max_time
+
+    """
+    Search the reply to every move the opponent could make, one depth at a
+    time across all of them, most likely moves first, until cancelled.
+    """
+    def ponder_replies(self, board):
+        self.ponder_cache = {}
+        self.search_start = time()
+        self.table.new_search()
+        self.nodes = 0
+        self.out_of_time = False
+        self.killers = {}
+        opponent_moves = self.search_moves(board, 0)
+        depth = 1
+        while depth <= max_search_depth and not self.out_of_time:
+            for source, destination in opponent_moves:
+                undo = board.make_move(source, destination)
+                # Only positions where it is this AI's turn are worth it
+                if board.curPlayer.AI is self and not board.winners():
+                    move = self.search_root(board, board.curPlayer, depth)
+                    if move != None:
+                        self.ponder_cache[board.hash] = (
+                                (move[0].index, move[1].index), depth)
+                board.unmake_move(undo)
+                if self.out_of_time:
+                    return
+            depth += 1
 
     """
     Evaluate the given board state to determine how good it is for the
-    current player.
+    current player. Each piece scores up to 500 for being close to the row in
+    front of the tip of its end triangle, plus 200 for being near the middle
+    columns, and the opponents' scores count against the player. The board
+    keeps each player's total up to date as moves are made, so this takes no
+    longer however many pieces there are.
     """
     def evaluate(self, player, board):
-        score = 0
-        y_space = 34
-        # Find tip of the end triangles
-        end_tip = filter(lambda p: len(p.neighbors) == 2, player.endTri.points)[0]
-        # And get the opponent and the position of its end triangle
-        opponent = board.players[(player.number + 2) % board.numPlayers]
-        opp_end_tip = filter(lambda p: len(p.neighbors) == 2, opponent.endTri.points)[0]
-        # Give points for all pieces
-        for piece in board.get_pieces(player):
-            # The closer to the end the better
-            score += 500 - abs(end_tip.yPos - y_space - piece.yPos)
-            # And make sure to be close horizontally
-            if piece.xPos >= 160 and piece.xPos <= 280:
-                score += 200
-        # Remove points for how well opponent is doing
-        for piece in board.get_pieces(opponent):
-            score -= 500 - abs(end_tip.yPos - y_space - piece.yPos)
-            if piece.xPos >= 160 and piece.xPos <= 280:
-                score -= 200
-        return score
+        progress = board.progress
+        # The player's own score, less that of every opponent
+        return 2 * progress[player.number] - sum(progress)
+
+    """
+    Make the opening book's move for this position, if there is a book and
+    it has one. Returns whether a move was made.
+    """
+    def book_move(self, board):
+        opening_book = book.get_book(board.numPlayers, self.book_directory)
+        if opening_book == None:
+            return False
+        move = book.best_move(board, opening_book)
+        if move == None:
+            return False
+        return board.make_move(board.cells[move[0]], board.cells[move[1]])
+
+    """
+    Make the move that the endgame table says finishes the game soonest, if
+    there is a table for the current player and it covers this position.
+    Returns whether a move was made.
+    """
+    def endgame_move(self, board):
+        table = endgame.get_table(board.numPlayers, board.curPlayer.number,
+                self.endgame_directory)
+        if table == None:
+            return False
+        move = endgame.best_move(board, table)
+        if move == None:
+            return False
+        return board.make_move(board.cells[move[0]], board.cells[move[1]])
 
     """
     A function that will force the AI to make a random move if its educated move-
@@ -93,66 +355,58 @@ class AI:
         # But fail to a random one
         return self.random_move(board, self.random_piece(board))
     
-    """
-    Find all possible jumps that a piece can make by starting in one direction.
-    """
-    def find_jumps(self, piece, jumps):
-        for direction in piece.neighbors:
-            if direction in piece.neighbors[direction].neighbors:
-                adjacent = piece.neighbors[direction]
-                dest = adjacent.neighbors[direction]
-                # If the destination is already in the jumps array, return
-                if dest in jumps:
-                    return jumps
-                # If there is something to skip over and land in
-                if adjacent.contents != 0 and dest.contents == 0:
-                    # Add the destination to the possible jumps
-                    jumps.append(dest)
-                    # Then find all possible jumps from that place
-                    jumps = self.find_jumps(dest, jumps)
-        return jumps
-    
     """
     Find all possible moves a piece can make and return them as
-    a list of point instances reachable from the start point.
+    a list of point instances reachable from the start point. Every step and
+    every place a chain of jumps can end is listed exactly once.
     """
-    def possible_moves(self, piece):
-        moves = []
-        # For all possible direction of the piece
-        for direction in piece.neighbors:
-            # Add the possible neighbouring moves
-            if piece.neighbors[direction].contents == 0:
-                moves.append(piece.neighbors[direction])
-        # And find all possible jumps
-        moves = self.find_jumps(piece, moves)
-        # Randomise the order so moves aren't always exactly the same
-        shuffle(moves)
-        return moves
+    def possible_moves(self, board, piece):
+        cells = board.cells
+        return [cells[i] for i in board.bits.destinations(piece.index)]
 
     """
     Simple function to pick a random piece that can move in at least one direction.
+    Returns None if no piece can move.
     """
     def random_piece(self, board):
         # Find all pieces belonging to the current player
-        player_pieces = board.get_pieces(board.curPlayer)
-        # Pick a random piece that has at least one empty neighbour
-        piece = None
-        while True:
-            # Pick random piece
-            piece = player_pieces[randint(0, len(player_pieces) - 1)]
-            # And make sure that it has at least one empty neighbor
-            if len(self.possible_moves(piece)) > 0:
-                break
-        return piece
+        # that have at least one place to move to
+        bits = board.bits
+        player_pieces = [piece for piece in board.get_pieces(board.curPlayer)
+                if bits.destinations(piece.index)]
+        if not player_pieces:
+            return None
+        # Pick a random one of them
+        return player_pieces[randint(0, len(player_pieces) - 1)]
+
+    # Whether the current player has any move at all
+    def has_moves(self, board):
+        bits = board.bits
+        for piece in board.get_pieces(board.curPlayer):
+            if bits.destinations(piece.index):
+                return True
+        return False
 
     """
-    A simple random move choser (always good for last-resort).
+    Pass the turn of a player who has no move to make. Returns False, as no
+    move was made.
+    """
+    def pass_turn(self, board):
+        board.passTurn()
+        return False
+
+    """
+    A simple random move choser (always good for last-resort). Passes the turn
+    if there is no piece (None) to move.
     """
     def random_move(self, board, piece):
+        if piece == None:
+            return self.pass_turn(board)
         # Now find the destinations it can move to
-        destinations = self.possible_moves(piece)
+        destinations = self.possible_moves(board, piece)
         # Then pick a random direction to move in
-        dest = destinations[randint(0, len(destinations) - 1)]
+        shuffle(destinations)
+        dest = destinations[0]
         # And make the move (it must be possible, but be sure of it)
         return self.final_move(board, piece, dest)
 
@@ -174,6 +428,9 @@ class AI:
         player = board.curPlayer
         # Pick a random piece to move
         piece = self.random_piece(board)
+        # Nothing can move, so the turn can only be passed
+        if piece == None:
+            return self.pass_turn(board)
         # Direction preferences
         prefs = [("down left", "down right"), ("up left", "up right")]
         # Pick which direction pair is preferred based on player
@@ -235,6 +492,9 @@ class AI:
     but tries to keep its own pieces together which should help with jumps.
     """
     def naive_maximizer_ai(self,board):
+        # Finish off the game from the endgame table if it covers this position
+        if self.endgame_move(board):
+            return True
         player=board.curPlayer
         score = 0
         # Find tip of the end triangles
@@ -245,25 +505,25 @@ class AI:
         farthest_piece_moves=[]
         all_moves=[]
         for piece in board.get_pieces(player):
-            if len(self.possible_moves(piece))>0 and self.has_useful_moves(piece,player,False):
-                all_moves=self.possible_moves(piece)
+            if len(self.possible_moves(board, piece))>0 and self.has_useful_moves(board,piece,player,False):
+                all_moves=self.possible_moves(board, piece)
                 cur_dist=abs((end_tip.yPos - 34) - piece.yPos)#vertical distance
                 cur_dist+=abs(end_tip.xPos - piece.xPos) #plus horizontal distance
                 if cur_dist>farthest_dist:
                     farthest_piece=piece
                     farthest_dist=cur_dist
-                    farthest_piece_moves=self.possible_moves(farthest_piece)
+                    farthest_piece_moves=self.possible_moves(board, farthest_piece)
         if farthest_piece_moves==[] and not all_moves==[]:
             farthest_piece_moves=all_moves #just move something if you can't move the back one
         if all_moves==[]: #no good moves, look for neutral ones
             for piece in board.get_pieces(player):
-                if len(self.possible_moves(piece))>0 and self.has_useful_moves(piece,player,True):
+                if len(self.possible_moves(board, piece))>0 and self.has_useful_moves(board,piece,player,True):
                     cur_dist=abs((end_tip.yPos - 34) - piece.yPos)#vertical distance
                     cur_dist+=abs(end_tip.xPos - piece.xPos) #plus horizontal distance
                     if cur_dist>farthest_dist:
                         farthest_piece=piece
                         farthest_dist=cur_dist
-                        moves=self.possible_moves(farthest_piece)
+                        moves=self.possible_moves(board, farthest_piece)
         if all_moves==[]: #no good or neutral moves, resort to directional AI
             return self.directional_slide_ai(board)
         best_move=all_moves[0]
@@ -292,9 +552,9 @@ class AI:
     """
     Returns true iff any of the piece's moves bring it strictly closer to the end
     """
-    def has_useful_moves(self,piece,player,horizOkay):
+    def has_useful_moves(self,board,piece,player,horizOkay):
         end_tip = filter(lambda p: len(p.neighbors) == 2, player.endTri.points)[0]
-        for move in self.possible_moves(piece):
+        for move in self.possible_moves(board, piece):
             cur_dist=abs((end_tip.yPos - 34) - piece.yPos)#vertical distance
             cur_dist+=abs(end_tip.xPos - piece.xPos) #plus horizontal distance
             post_move_dist=abs((end_tip.yPos - 34) - move.yPos)#vertical distance
@@ -306,10 +566,16 @@ class AI:
         """
     An AI player that generates a tree of game states and then searches for the
     move that will have the best outcome further down the line.
-    An element is made of its score value, the move that got it there and the
-    board object that it results in.
+    An element is made of its score value and the move that got it there; the
+    root also holds the board, which the search plays moves on and takes back.
     """
     def best_score(self, board):
+        # Play from the opening book or endgame table if they know this position
+        if self.book_move(board) or self.endgame_move(board):
+            return True
+        # With no moves at all, the turn can only be passed
+        if not self.has_moves(board):
+            return self.pass_turn(board)
         # Start search timer
         self.search_start = time()
         # Start the tree with the current game state
@@ -319,13 +585,15 @@ class AI:
             "board": board })
         # Then find all possible states leading from it
         game_tree.children = self.build_tree(board, 1, 0)
+        # If time ran out before any move was looked at, make a directional one
+        if not game_tree.children:
+            return self.directional_slide_ai(board)
         # Now find the best possible move
         self.find_best(game_tree)
         move = game_tree.element["move"]
         # If we have no move, then make a directional one
         if move == None:
             return self.directional_slide_ai(board)
-        end_tip = filter(lambda p: len(p.neighbors) == 2, board.curPlayer.endTri.points)[0]
         # And finally make the move
         return self.final_move(board, move[0], move[1])
 
@@ -339,29 +607,30 @@ class AI:
         moves = []
         # Find all possible moves the player can make
         for piece in board.get_pieces(board.curPlayer):
-            for move in self.possible_moves(piece):
+            for move in self.possible_moves(board, piece):
                 # Get only the coordinates of the move
                 src = (piece.xPos, piece.yPos)
                 dest = (move.xPos, move.yPos)
                 moves.append((src, dest))
         nodes = [] # Tree nodes to return
+        # Scores are from the point of view of the player making the moves
+        player = board.curPlayer
         # For every possible move, generate a tree item and keep looking
         for move in moves:
             # Make sure that the AI does not spend too long searching
-            if time() - self.search_start >= self.max_time:
+            if self.should_stop():
                 break
-            # Get a new board object by copying the old one
-            new_board = deepcopy(board)
-            # Make the move (thus changing player's turn)
-            new_board.make_move(move[0], move[1])
+            # Make the move on the board itself (thus changing player's turn)
+            undo = board.make_move(move[0], move[1])
             # Build a tree node to add to the list of nodes
             node = TreeNode({
-                "score": self.evaluate(board.curPlayer, new_board),
-                "move": move,
-                "board": new_board })
+                "score": self.evaluate(player, board),
+                "move": move })
             # Now look further down the tree
-            node.children = self.build_tree(new_board, max_depth, depth + 1)
+            node.children = self.build_tree(board, max_depth, depth + 1)
             nodes.append(node)
+            # Then take the move back before trying the next one
+            board.unmake_move(undo)
         return nodes
 
     """
@@ -382,3 +651,198 @@ class AI:
                 game_tree.element["move"] = node.element["move"]
                 game_tree.element["score"] = node.element["score"]
                 return
+
+    """
+    An AI player that searches the game tree with alpha-beta pruning, one
+    depth at a time, until it runs out of time. It then plays the best move of
+    the deepest search it finished. Nothing but the transposition table is
+    kept between depths, so memory does not grow with the depth reached.
+    With three players, the two opponents are assumed to be working together
+    against it (a "paranoid" search).
+    """
+    def alpha_beta_ai(self, board):
+        # Play from the opening book or endgame table if they know this position
+        if self.book_move(board) or self.endgame_move(board):
+            return True
+        # Start search timer
+        self.search_start = time()
+        self.table.new_search()
+        self.nodes = 0
+        self.out_of_time = False
+        self.depth_reached = 0
+        self.killers = {}
+        # Let old cutoffs count for less than the ones of this search
+        for move in self.history.keys():
+            self.history[move] /= 2
+        player = board.curPlayer
+        best = None
+        depth = 1
+        # Carry on from where pondering got to, if it saw this position
+        pondered = self.ponder_cache.get(board.hash)
+        self.ponder_cache = {}
+        if pondered != None:
+            move, searched = pondered
+            best = (board.cells[move[0]], board.cells[move[1]])
+            self.depth_reached = searched
+            depth = searched + 1
+        # Go one level deeper each time, until time runs out or the whole
+        # game has been searched
+        while depth <= max_search_depth:
+            move = self.search_root(board, player, depth)
+            # Nothing to search if there are no moves at all
+            if self.out_of_time or move == None:
+                break
+            best = move
+            self.depth_reached = depth
+            if self.on_progress != None:
+                self.on_progress(depth, self.nodes, time() - self.search_start,
+                        ((best[0].xPos, best[0].yPos), (best[1].xPos, best[1].yPos)))
+            depth += 1
+        # If we have no move, then make a directional one, unless there are
+        # no moves at all
+        if best == None:
+            if not self.has_moves(board):
+                return self.pass_turn(board)
+            return self.directional_slide_ai(board)
+        # And finally make the move
+        return self.final_move(board, best[0], best[1])
+
+    """
+    Search every move of the current player to a given depth, and return the
+    best move (or None if the search ran out of time).
+    """
+    def search_root(self, board, player, depth):
+        alpha = -win_score * 2
+        beta = win_score * 2
+        best = None
+        for source, destination in self.search_moves(board, 0):
+            undo = board.make_move(source, destination)
+            score = self.search(board, player, depth - 1, alpha, beta, 1)
+            board.unmake_move(undo)
+            if self.out_of_time:
+                return None
+            if best == None or score > alpha:
+                alpha = score
+                best = (source, destination)
+        # Remember the best move so the next depth searches it first
+        if best != None:
+            self.table.store(board.hash, depth, alpha, TranspositionTable.EXACT,
+                    (best[0].index, best[1].index))
+        return best
+
+    """
+    Score a position by searching it to the given depth with alpha-beta
+    pruning. Scores are from the given player's point of view: that player
+    picks the highest scoring move and everyone else the lowest.
+    """
+    def search(self, board, player, depth, alpha, beta, ply):
+        # Check the clock every so often
+        self.nodes += 1
+        if self.nodes % 256 == 0 and self.should_stop():
+            self.out_of_time = True
+        if self.out_of_time:
+            return 0
+        # A finished game is scored by who won, sooner being better
+        winners = board.winners()
+        if winners:
+            if player.number in winners:
+                return win_score + depth
+            return -win_score - depth
+        if depth <= 0:
+            return self.evaluate(player, board)
+        # Use what is known about this position from earlier searches
+        entry = self.table.lookup(board.hash)
+        if entry != None and entry[1] >= depth:
+            score, flag = entry[2], entry[3]
+            if flag == TranspositionTable.EXACT:
+                return score
+            if flag == TranspositionTable.LOWER and score > alpha:
+                alpha = score
+            elif flag == TranspositionTable.UPPER and score < beta:
+                beta = score
+            if alpha >= beta:
+                return score
+        maximizing = board.curPlayer == player
+        first_alpha, first_beta = alpha, beta
+        best = None
+        best_move = None
+        for source, destination in self.search_moves(board, ply, entry):
+            undo = board.make_move(source, destination)
+            score = self.search(board, player, depth - 1, alpha, beta, ply + 1)
+            board.unmake_move(undo)
+            if self.out_of_time:
+                return 0
+            if maximizing:
+                if best == None or score > best:
+                    best, best_move = score, (source.index, destination.index)
+                    alpha = max(alpha, score)
+            else:
+                if best == None or score < best:
+                    best, best_move = score, (source.index, destination.index)
+                    beta = min(beta, score)
+            # The other side will never allow this position, so stop looking
+            if alpha >= beta:
+                self.add_cutoff(best_move, depth, ply)
+                break
+        # No moves at all, so just score the position as it is
+        if best == None:
+            return self.evaluate(player, board)
+        # Store the result, noting if it is only a bound due to a cutoff
+        if best <= first_alpha:
+            flag = TranspositionTable.UPPER
+        elif best >= first_beta:
+            flag = TranspositionTable.LOWER
+        else:
+            flag = TranspositionTable.EXACT
+        self.table.store(board.hash, depth, best, flag, best_move)
+        return best
+
+    """
+    List every move the current player can make as (source, destination)
+    point pairs, in the order they should be searched: the best move of an
+    earlier search, then moves that caused cutoffs at the same ply, then by
+    how far they bring the piece toward its end triangle and how often they
+    have caused cutoffs before. entry is the position's table entry, if the
+    caller has already looked it up.
+    """
+    def search_moves(self, board, ply, entry=None):
+        moves = []
+        for piece in board.get_pieces(board.curPlayer):
+            for move in self.possible_moves(board, piece):
+                moves.append((piece, move))
+        table_move = None
+        if entry == None:
+            entry = self.table.find(board.hash)
+        if entry != None:
+            table_move = entry[4]
+        return self.order_moves(board.curPlayer, moves, table_move,
+                self.killers.get(ply, []))
+
+    """
+    Sort (source, destination) point pairs so the most promising come first.
+    """
+    def order_moves(self, player, moves, table_move, killers):
+        end_tip = player.endTri.tip
+        history = self.history
+        def priority(move):
+            source, destination = move
+            key = (source.index, destination.index)
+            # Rows and then columns gained toward the tip of the end triangle
+            rows = abs(end_tip.yPos - source.yPos) - abs(end_tip.yPos - destination.yPos)
+            columns = abs(end_tip.xPos - source.xPos) - abs(end_tip.xPos - destination.xPos)
+            return (key == table_move, key in killers, rows, columns,
+                    history.get(key, 0))
+        moves.sort(key = priority, reverse = True)
+        return moves
+
+    """
+    Remember a move that caused a cutoff, as a killer move for its ply and in
+    the history table (weighted so cutoffs far from the leaves count more).
+    """
+    def add_cutoff(self, move, depth, ply):
+        killers = self.killers.setdefault(ply, [])
+        if move not in killers:
+            # Keep the two most recent killers
+            killers.insert(0, move)
+            del killers[2:]
+        self.history[move] = self.history.get(move, 0) + depth * depth
@@ -1,6 +1,6 @@
 from random import randint, shuffle
-from copy import deepcopy
 from time import time
+from ai import TranspositionTable
 
 """
 This is the file containing only the random AI and what it requires for use.
@@ -37,6 +37,8 @@ class AI:
         self.max_time = 1
         # Time that a move search started
         self.search_start = 0
+        # Scores of positions already seen, kept between turns of the game
+        self.table = TranspositionTable()
 
     """
     Evaluate the given board state to determine how good it is for the
@@ -69,6 +71,18 @@ class AI:
                 score -= 200
         return score
 
+    """
+    Evaluate a board state, reusing the score if the position has been
+    evaluated before.
+    """
+    def table_evaluate(self, player, board):
+        entry = self.table.lookup(board.hash)
+        if entry != None:
+            return entry[2]
+        score = self.evaluate(player, board)
+        self.table.store(board.hash, 0, score, TranspositionTable.EXACT, None)
+        return score
+
     """
     A function that will force the AI to make a random move if its educated move-
     generator did not work.
@@ -160,6 +174,7 @@ class AI:
         max_depth = 7
         # Start search timer
         self.search_start = time()
+        self.table.new_search()
         # Start the tree with the current game state
         game_tree = TreeNode({
             "score": 0,
@@ -168,7 +183,7 @@ class AI:
             "depth": max_depth + 1,
             "parents": [] })
         # Build the tree breadth-first-ish up to a certain depth
-        self.build_faild_tree(board.curPlayer.number, game_tree, max_depth)
+        self.build_faild_tree(board.curPlayer.number, board, game_tree, max_depth)
         # Find the best-looking move to make
         self.find_failed_best(game_tree)
         move = game_tree.element["move"]
@@ -180,16 +195,17 @@ class AI:
 
     """
     Find and evaluate all possible moves for a given state,
-    up to a given depth.
+    up to a given depth. The moves are played on the board and taken back,
+    so the board is left as it was found.
     """
-    def build_faild_tree(self, player, root, depth):
+    def build_faild_tree(self, player, board, root, depth):
         # Do not go too deep
         if depth <= 0:
             return
-        board = root.element["board"]
+        mover = board.curPlayer
         # Generate all possible moves for this current state,
         # and make a node for each
-        for piece in board.get_pieces(board.curPlayer):
+        for piece in board.get_pieces(mover):
             for move in self.possible_moves(piece):
                 # Make sure that the AI does not search for too long
                 if time() - self.search_start >= self.max_time:
@@ -197,26 +213,30 @@ class AI:
                 # Get only the coordinates of the move
                 src = (piece.xPos, piece.yPos)
                 dest = (move.xPos, move.yPos)
-                # Make a new board to make the move on
-                new_board = deepcopy(board)
-                new_board.make_move(src, dest)
+                # Make the move on the board to evaluate it
+                undo = board.make_move(src, dest)
                 # Make the node and append it to the root's children
                 root.children.append(TreeNode({
-                    "score": self.evaluate(board.curPlayer, new_board),
+                    "score": self.table_evaluate(mover, board),
                     "move": (src, dest),
-                    "board": new_board,
+                    "turn": board.curPlayer.number, # Who moves next
                     "depth": depth, # Where 0 is deepest
                     # Keep track of parents
                     "parents": root.element["parents"] + [root]
                 }))
+                # And take it back again
+                board.unmake_move(undo)
         # Sort the children by score
-        reverse = player == board.curPlayer.number
+        reverse = player == mover.number
         root.children.sort(key = lambda node: node.element["score"], reverse = reverse)
         # Only hold on to best 5
         root.children = root.children[:5]
         # Loop through best five children and recurse
         for i in range(len(root.children)):
-            root.children[i] = self.build_faild_tree(player, root.children[i], depth - 1)
+            move = root.children[i].element["move"]
+            undo = board.make_move(move[0], move[1])
+            root.children[i] = self.build_faild_tree(player, board, root.children[i], depth - 1)
+            board.unmake_move(undo)
         return root
 
     """
@@ -235,7 +255,7 @@ class AI:
             if leaf.element["depth"] != 0:
                 continue
             # Then check if we're finding worst for opponent or best for player
-            if player_num == leaf.element["board"].number:
+            if player_num == leaf.element["turn"]:
                 # Then find the one with the highest score
                 if leaf.element["score"] > best.element["score"]:
                     best = leaf
@@ -0,0 +1,114 @@
+"""
+Score many board states at once with NumPy, using the same heuristics as
+AI.evaluate (or the steeper one of ai_failed.py). A state is a row of one
+int8 per board index holding the number of the player on it (0 if empty), so
+N states are an (N, cells) array. NumPy is only needed by this module.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from bitboard import get_tables, centre_columns, centre_bonus, end_triangles
+
+# Score matrices that have been built, by (number of players, quadratic)
+built_matrices = {}
+
+"""
+Make sure NumPy can be used.
+"""
+def need_numpy():
+    if numpy == None:
+        raise ImportError("NumPy is needed to evaluate board states in batches.")
+
+"""
+Score a single piece the way ai_failed.py does: falling off with the square
+of the number of rows to the row in front of the tip of its end triangle.
+"""
+def quadratic_piece_score(pos, tip):
+    distance = abs(tip[1] - 34 - pos[1]) // 34
+    score = 500 - 3 * distance ** 2
+    if centre_columns[0] <= pos[0] <= centre_columns[1]:
+        score += centre_bonus
+    return score
+
+"""
+Get the (players + 1, cells) matrix of the score of each player's piece on
+each index (row 0 is all zeros, for empty indices).
+"""
+def score_matrix(numPlayers, quadratic=False):
+    need_numpy()
+    key = (numPlayers, quadratic)
+    if key not in built_matrices:
+        tables = get_tables(numPlayers)
+        if not quadratic:
+            # The same scores the board adds up for AI.evaluate
+            rows = tables.scores
+        else:
+            rows = [[0] * tables.size]
+            for number in range(1, numPlayers + 1):
+                tip = tables.positions[tables.tips[end_triangles[numPlayers][number]]]
+                rows.append([quadratic_piece_score(pos, tip) for pos in tables.positions])
+        built_matrices[key] = numpy.array(rows, dtype = numpy.int64)
+    return built_matrices[key]
+
+"""
+Get the state of a board as a row of player numbers, one per index.
+"""
+def board_state(board):
+    need_numpy()
+    state = numpy.zeros(board.tables.size, dtype = numpy.int8)
+    for p in board.players:
+        state[board.bits.pieces(p.number)] = p.number
+    return state
+
+"""
+Get the states of many boards (all with the same number of players) as an
+(N, cells) array.
+"""
+def board_states(boards):
+    need_numpy()
+    return numpy.array([board_state(b) for b in boards], dtype = numpy.int8)
+
+"""
+Score an (N, cells) array of states for the given player number, returning
+N scores: the player's pieces less every opponent's, as in AI.evaluate.
+"""
+def evaluate_states(states, number, numPlayers, quadratic=False):
+    matrix = score_matrix(numPlayers, quadratic)
+    states = numpy.asarray(states)
+    # totals[i, p] is the score of player p's pieces in state i
+    totals = numpy.zeros((len(states), numPlayers + 1), dtype = numpy.int64)
+    for p in range(1, numPlayers + 1):
+        totals[:, p] = (states == p).dot(matrix[p])
+    return 2 * totals[:, number] - totals.sum(axis = 1)
+
+"""
+Find every move the current player can make and the state each one leads
+to. Returns the moves as (source index, destination index) pairs and an
+(N, cells) array of the resulting states.
+"""
+def child_states(board):
+    need_numpy()
+    number = board.curPlayer.number
+    moves = []
+    for piece in board.get_pieces(board.curPlayer):
+        for destination in board.bits.destinations(piece.index):
+            moves.append((piece.index, destination))
+    states = numpy.tile(board_state(board), (len(moves), 1))
+    if moves:
+        rows = numpy.arange(len(moves))
+        indices = numpy.array(moves)
+        states[rows, indices[:, 0]] = 0
+        states[rows, indices[:, 1]] = number
+    return moves, states
+
+"""
+Score every move the current player can make, in one NumPy call, from the
+given player's point of view. Returns the moves (as in child_states) and
+their scores.
+"""
+def evaluate_children(board, player, quadratic=False):
+    moves, states = child_states(board)
+    return moves, evaluate_states(states, player.number, board.numPlayers, quadratic)
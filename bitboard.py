@@ -0,0 +1,313 @@
+"""
+A compact representation of the board for the AI. Every position on the board
+is given an index, and the pieces of each player are kept as the bits of an
+integer, so moving a piece or checking a win is a couple of integer operations
+instead of a walk over point objects.
+"""
+
+from random import Random
+
+# The six directions, in the same words used by point.neighbors
+directions = ["up left", "up right", "left", "right", "down left", "down right"]
+# Pixel offset to the neighbouring position in each direction
+offsets = [(-20, -34), (20, -34), (-40, 0), (40, 0), (-20, 34), (20, 34)]
+
+# Largest board and number of players that hash keys are made for
+max_cells = 128
+max_players = 3
+# Random 64-bit keys for Zobrist hashing. They come from a fixed seed so that
+# a position hashes the same in every run and hashes can be kept on disk.
+zobrist_random = Random(2006)
+# zobrist_pieces[number][index] is the key for player number's piece on index
+zobrist_pieces = [[zobrist_random.getrandbits(64) for i in range(max_cells)]
+                  for number in range(max_players + 1)]
+# An empty index adds nothing to the hash
+zobrist_pieces[0] = [0] * max_cells
+# zobrist_turn[number] is the key for player number being the one to move
+zobrist_turn = [zobrist_random.getrandbits(64) for number in range(max_players + 1)]
+
+"""
+Hash a position from scratch: the pieces on a bitboard and whose turn it is.
+"""
+def zobrist_hash(bits, turn):
+    value = zobrist_turn[turn]
+    for number in range(1, len(bits.masks)):
+        for index in bit_indices(bits.masks[number]):
+            value ^= zobrist_pieces[number][index]
+    return value
+
+# Positions of the hexagon in the middle of the board. Adjacent positions
+# have a y separation of 0 pixels and an x separation of 40 pixels, or an
+# x separation of 20 and a y separation of 34.
+hexagon_widths = [3, 4, 5, 4, 3] # widths of the rows of the hexagon
+hexagon_offsets = [180, 160, 140, 160, 180] # x of the leftmost point of each row
+hexagon_top = 170 # y of the top row
+# Position of the leftmost point of the topmost row of each triangle
+triangle_offsets = {"top": (220, 34), "upper left": (40, 136),
+        "upper right": (280, 136), "lower left": (100, 238),
+        "lower right": (340, 238), "bottom": (160, 340)}
+# Orientation of each player's end triangle, by number of players
+end_triangles = {2: {1: "bottom", 2: "top"},
+        3: {1: "lower left", 2: "lower right", 3: "top"}}
+# Pieces score more the closer they are to the row in front of the tip of
+# their end triangle, with a bonus for being within these columns
+centre_columns = (160, 280)
+centre_bonus = 200
+
+"""
+Return the positions of the points of the hexagon, row by row.
+"""
+def hexagon_positions():
+    positions = []
+    for y in range(0, 5):
+        for x in range(0, hexagon_widths[y]):
+            positions.append((hexagon_offsets[y] + 40 * x, hexagon_top + 34 * y))
+    return positions
+
+"""
+Return the positions of the points of a triangle, row by row.
+"""
+def triangle_positions(orientation):
+    if orientation in ["top", "lower left", "lower right"]:
+        width = [1, 2, 3, 4] # widths of the rows of the triangle
+        perRowXOffset = -20 # bottom left corner is left of top corner
+    else:
+        width = [4, 3, 2, 1]
+        perRowXOffset = 20 # bottom corner is right of top left corner
+    positions = []
+    for y in range(0, 4):
+        for x in range(0, width[y]):
+            positions.append((triangle_offsets[orientation][0] + perRowXOffset * y + 40 * x,
+                              triangle_offsets[orientation][1] + 34 * y))
+    return positions
+
+"""
+Score a single piece at a position, for a player whose end triangle has its
+tip at the given position.
+"""
+def piece_score(pos, tip):
+    score = 500 - abs(tip[1] - 34 - pos[1])
+    if centre_columns[0] <= pos[0] <= centre_columns[1]:
+        score += centre_bonus
+    return score
+
+"""
+Return the indices of the set bits of a mask, lowest first.
+"""
+def bit_indices(mask):
+    indices = []
+    while mask:
+        # Isolate the lowest set bit
+        low = mask & -mask
+        indices.append(low.bit_length() - 1)
+        mask ^= low
+    return indices
+
+"""
+Return a mask with the bits of all the given indices set.
+"""
+def indices_mask(indices):
+    mask = 0
+    for index in indices:
+        mask |= 1 << index
+    return mask
+
+"""
+The layout of the board, which never changes during a game. Everything is
+worked out once for each number of players (see get_tables), and every board
+then shares it.
+"""
+class tables:
+    def __init__(self, numPlayers):
+        self.numPlayers = numPlayers
+        # Positions in the hexagon and in each triangle. Neighbouring
+        # triangles share their corner positions.
+        self.hexagon = hexagon_positions()
+        self.triangle_positions = {}
+        positions = set(self.hexagon)
+        for orientation in triangle_offsets:
+            self.triangle_positions[orientation] = triangle_positions(orientation)
+            positions.update(self.triangle_positions[orientation])
+        # Number the positions row by row, top to bottom and left to right
+        self.positions = sorted(positions, key = lambda pos: (pos[1], pos[0]))
+        self.size = len(self.positions)
+        # Position (x,y) --> index
+        self.index = {}
+        for i in range(self.size):
+            self.index[self.positions[i]] = i
+        # For each index, the neighbouring index in each direction (or None)
+        self.neighbors = []
+        # For each index, (direction word, neighbouring index) pairs
+        self.directed = []
+        # For each index, the indices one step away
+        self.steps = []
+        # For each index, (jumped over, landing) index pairs
+        self.jumps = []
+        for pos in self.positions:
+            neighbors = []
+            steps = []
+            jumps = []
+            for dx, dy in offsets:
+                adjacent = (pos[0] + dx, pos[1] + dy)
+                landing = (pos[0] + 2 * dx, pos[1] + 2 * dy)
+                if adjacent not in self.index:
+                    neighbors.append(None)
+                    continue
+                neighbors.append(self.index[adjacent])
+                steps.append(self.index[adjacent])
+                if landing in self.index:
+                    jumps.append((self.index[adjacent], self.index[landing]))
+            self.neighbors.append(neighbors)
+            self.directed.append([(directions[d], neighbors[d])
+                    for d in range(len(directions)) if neighbors[d] != None])
+            self.steps.append(steps)
+            self.jumps.append(jumps)
+        # Indices and mask of the points in each triangle
+        self.triangles = {}
+        self.triangle_masks = {}
+        for orientation in triangle_offsets:
+            indices = [self.index[pos] for pos in self.triangle_positions[orientation]]
+            self.triangles[orientation] = indices
+            self.triangle_masks[orientation] = indices_mask(indices)
+        # The tip of each triangle, the only point with two neighbours
+        self.tips = {}
+        for orientation in self.triangles:
+            for i in self.triangles[orientation]:
+                if len(self.steps[i]) == 2:
+                    self.tips[orientation] = i
+        # For each player number, the score of a piece on each index
+        # (index 0 is unused so player numbers can be used directly)
+        self.scores = [[0] * self.size]
+        for number in range(1, numPlayers + 1):
+            tip = self.positions[self.tips[end_triangles[numPlayers][number]]]
+            self.scores.append([piece_score(pos, tip) for pos in self.positions])
+
+# Tables that have been built, by number of players
+built_tables = {}
+
+"""
+Get the tables for a number of players, building them the first time.
+"""
+def get_tables(numPlayers):
+    if numPlayers not in built_tables:
+        built_tables[numPlayers] = tables(numPlayers)
+    return built_tables[numPlayers]
+
+"""
+Every index a piece on the given index can move to, when the indices in the
+occupied mask hold pieces: single steps, and the landing spot of every chain
+of jumps. Each destination is listed once, steps first, and the piece's own
+index is never listed.
+"""
+def reachable(tables, occupied, index):
+    # The piece being moved has left its index, so can't be jumped over
+    occupied &= ~(1 << index)
+    found = []
+    # Indices already listed
+    listed = 1 << index
+    for step in tables.steps[index]:
+        if not occupied >> step & 1:
+            found.append(step)
+            listed |= 1 << step
+    # Search every chain of jumps, landing on each index at most once
+    landed = 1 << index
+    frontier = [index]
+    while frontier:
+        current = frontier.pop()
+        for over, land in tables.jumps[current]:
+            if occupied >> over & 1 and not (occupied | landed) >> land & 1:
+                landed |= 1 << land
+                frontier.append(land)
+                if not listed >> land & 1:
+                    found.append(land)
+                    listed |= 1 << land
+    return found
+
+class bitboard:
+    def __init__(self, tables, numPlayers):
+        self.tables = tables
+        # One mask per player number; index 0 is unused so player numbers
+        # can be used directly
+        self.masks = [0] * (numPlayers + 1)
+        # Mask of every position holding a piece
+        self.occupied = 0
+
+    # Put the given player's piece on an index (0 empties it)
+    def place(self, index, number):
+        bit = 1 << index
+        # Clear whatever was there before
+        for i in range(1, len(self.masks)):
+            self.masks[i] &= ~bit
+        self.occupied &= ~bit
+        if number != 0:
+            self.masks[number] |= bit
+            self.occupied |= bit
+
+    # Put the given player's pieces on every empty index of a mask
+    def fill(self, mask, number):
+        mask &= ~self.occupied
+        self.masks[number] |= mask
+        self.occupied |= mask
+
+    # Get the number of the player on an index (0 if empty)
+    def contents(self, index):
+        bit = 1 << index
+        if not self.occupied & bit:
+            return 0
+        for i in range(1, len(self.masks)):
+            if self.masks[i] & bit:
+                return i
+
+    # Move a piece between two indices, returning the player that moved
+    def move(self, source, destination):
+        number = self.contents(source)
+        change = (1 << source) | (1 << destination)
+        self.masks[number] ^= change
+        self.occupied ^= change
+        return number
+
+    # Indices of all of a player's pieces
+    def pieces(self, number):
+        return bit_indices(self.masks[number])
+
+    # Indices that a piece on the given index can step to
+    def step_moves(self, index):
+        return [i for i in self.tables.steps[index] if not self.occupied >> i & 1]
+
+    # Indices that a piece on the given index can reach with a single jump
+    def jump_moves(self, index):
+        occupied = self.occupied
+        return [land for over, land in self.tables.jumps[index]
+                if occupied >> over & 1 and not occupied >> land & 1]
+
+    # Every index a piece on the given index can move to (see reachable)
+    def destinations(self, index):
+        return reachable(self.tables, self.occupied, index)
+
+    # Like destinations, but map each destination to the shortest path of
+    # indices that reaches it, starting with the given index
+    def paths(self, index):
+        tables = self.tables
+        occupied = self.occupied & ~(1 << index)
+        paths = {}
+        for step in tables.steps[index]:
+            if not occupied >> step & 1:
+                paths[step] = [index, step]
+        # Breadth first, so each landing is first reached by a shortest chain
+        landed = 1 << index
+        frontier = [[index]]
+        while frontier:
+            following = []
+            for chain in frontier:
+                for over, land in tables.jumps[chain[-1]]:
+                    if occupied >> over & 1 and not (occupied | landed) >> land & 1:
+                        landed |= 1 << land
+                        following.append(chain + [land])
+                        if land not in paths:
+                            paths[land] = chain + [land]
+            frontier = following
+        return paths
+
+    # Whether a player's pieces cover every index of a mask
+    def fills(self, number, mask):
+        return self.masks[number] & mask == mask
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""
+Opening book: good moves for the first turns of a game, looked up by the
+board's position hash so the AI does not have to search them.
+
+The book is made by running this module, which plays games between AIs
+without a screen, each starting with a few random moves so that no two are
+the same, and keeps the moves both sides chose after those, weighted by how
+the game went for the player who made them. It is written as a sorted list
+of fixed-size records, and the AI finds a position's moves by binary search
+through the file mapped with mmap. A move is only played from the book once
+enough games back it up.
+
+Example: ./book.py --players 2 --games 200 --plies 16
+"""
+
+import os
+import sys
+import mmap
+import random
+import struct
+from argparse import ArgumentParser
+from multiprocessing import Pool, cpu_count
+
+# Start of every book file, and the version of its format
+magic = "PDOB"
+version = 1
+# magic, version, players, number of records
+header_format = "<4sBBI"
+# position hash, source index, destination index, weight
+record_format = "<QBBH"
+record_size = struct.calcsize(record_format)
+# Directory books are read from when none is given
+default_directory = os.path.dirname(os.path.abspath(__file__))
+# Weight a move gets from a game the player who made it won, a game nobody
+# won, and a game the player lost
+win_weight = 3
+draw_weight = 2
+loss_weight = 1
+# Least total weight a move needs before it is played from the book, so a
+# move seen in a single game is never trusted
+min_weight = 4
+
+class OpeningBook:
+    def __init__(self, numPlayers, data, start, count):
+        self.numPlayers = numPlayers
+        # Where the records are, and how many there are
+        self.data = data
+        self.start = start
+        self.count = count
+
+    # Get the position hash of a record
+    def key(self, i):
+        offset = self.start + i * record_size
+        return struct.unpack("<Q", self.data[offset:offset + 8])[0]
+
+    """
+    Find every move stored for a position hash, as (source index, destination
+    index, weight), most played first.
+    """
+    def lookup(self, key):
+        # Find the first record with this hash
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        moves = []
+        while low < self.count and self.key(low) == key:
+            offset = self.start + low * record_size
+            moves.append(struct.unpack(record_format,
+                    self.data[offset:offset + record_size])[1:])
+            low += 1
+        moves.sort(key = lambda move: move[2], reverse = True)
+        return moves
+
+"""
+Write a book from a dictionary of position hash --> {(source, destination):
+weight}.
+"""
+def save(path, numPlayers, positions):
+    records = []
+    for key in positions:
+        for move, weight in positions[key].items():
+            records.append((key, move[0], move[1], min(weight, 0xffff)))
+    records.sort()
+    f = open(path, "wb")
+    f.write(struct.pack(header_format, magic, version, numPlayers, len(records)))
+    for record in records:
+        f.write(struct.pack(record_format, *record))
+    f.close()
+
+"""
+Map a book file into memory, or return None if the file is not a book.
+"""
+def load(path):
+    f = open(path, "rb")
+    data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    f.close()
+    start = struct.calcsize(header_format)
+    if len(data) < start:
+        return None
+    header = struct.unpack(header_format, data[:start])
+    if header[0] != magic or header[1] != version or\
+            len(data) < start + header[3] * record_size:
+        return None
+    return OpeningBook(header[2], data, start, header[3])
+
+"""
+Get the file name of the book for a number of players.
+"""
+def book_path(numPlayers, directory=None):
+    if directory == None:
+        directory = default_directory
+    return os.path.join(directory, "openings" + str(numPlayers) + ".book")
+
+# Books that have been loaded (or found missing), by path
+loaded = {}
+
+"""
+Get the book for a number of players, loading it the first time. Returns
+None if there is no book file.
+"""
+def get_book(numPlayers, directory=None):
+    path = book_path(numPlayers, directory)
+    if path not in loaded:
+        if os.path.exists(path):
+            loaded[path] = load(path)
+        else:
+            loaded[path] = None
+    return loaded[path]
+
+"""
+Find the most played book move for the current position that can actually
+be made and has at least min_weight, as (source index, destination index),
+or None.
+"""
+def best_move(board, book):
+    if book.numPlayers != board.numPlayers:
+        return None
+    for source, destination, weight in book.lookup(board.hash):
+        # The rest are weighted even less
+        if weight < min_weight:
+            return None
+        # Make sure it is really this position and not a hash collision
+        if board.cells[source].contents == board.curPlayer.number and\
+                destination in board.bits.destinations(source):
+            return (source, destination)
+    return None
+
+"""
+Make a random move for the current player that takes a piece closer to
+their end triangle. Returns False if there is none.
+"""
+def random_move(board):
+    number = board.curPlayer.number
+    scores = board.tables.scores[number]
+    moves = []
+    for piece in board.bits.pieces(number):
+        for destination in board.bits.destinations(piece):
+            if scores[destination] > scores[piece]:
+                moves.append((piece, destination))
+    if not moves:
+        return False
+    source, destination = random.choice(moves)
+    return board.make_move(board.cells[source], board.cells[destination])
+
+"""
+Get the weight a game gives the moves of a player (see win_weight).
+"""
+def result_weight(number, winners):
+    if not winners:
+        return draw_weight
+    if number in winners:
+        return win_weight
+    return loss_weight
+
+"""
+Play one game between AIs and return the winners, the opening moves as
+(position hash, source index, destination index, player number) and what
+went wrong (None if nothing did). The job
+is (players, difficulty, seed, plies, random plies, max moves, max search
+time); the seed picks the random moves the game starts with, which are not
+part of the opening returned.
+"""
+def self_play(job):
+    # diamond imports the AI, which imports this module, so it can only be
+    # imported once everything has loaded
+    import diamond
+    numPlayers, difficulty, seed, plies, random_plies, max_moves, max_time = job
+    random.seed(seed)
+    b = diamond.board(numPlayers, [True] * numPlayers, [difficulty] * numPlayers)
+    for p in b.players:
+        p.AI.max_time = max_time
+    try:
+        for i in range(random_plies):
+            if not random_move(b):
+                break
+        winners = diamond.run_game(b, max_moves)
+    # A broken AI spoils the game rather than stopping the run
+    except Exception as e:
+        return [], [], "player " + str(b.curPlayer.number) + ": " + repr(e)
+    # Play the opening again to find the hash of each position, keeping only
+    # the moves the AIs chose
+    replay = diamond.board(numPlayers, [False] * numPlayers, [0] * numPlayers)
+    opening = []
+    for i in range(min(plies, len(b.moves))):
+        source = replay.get_point(b.moves[i][0])
+        destination = replay.get_point(b.moves[i][1])
+        if i >= random_plies:
+            opening.append((replay.hash, source.index, destination.index,
+                    replay.curPlayer.number))
+        replay.make_move(source, destination)
+    return winners, opening, None
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description = "Build an opening book from self-play.")
+    parser.add_argument("--players", type = int, default = 2, choices = [2, 3])
+    parser.add_argument("--games", type = int, default = 200)
+    parser.add_argument("--plies", type = int, default = 16,
+            help = "moves from the start of each game to keep (default 16)")
+    parser.add_argument("--random-plies", type = int, default = 2,
+            help = "random moves each game starts with (default 2)")
+    parser.add_argument("--difficulty", type = int, default = 4,
+            help = "AI difficulty that plays the games (default 4)")
+    parser.add_argument("--max-time", type = float, default = 0.5,
+            help = "seconds the AI may think per move")
+    parser.add_argument("--max-moves", type = int, default = 1000)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--processes", type = int, default = cpu_count())
+    parser.add_argument("--directory", default = default_directory,
+            help = "where to write the book")
+    args = parser.parse_args()
+    jobs = [(args.players, args.difficulty, args.seed + i, args.plies,
+            args.random_plies, args.max_moves, args.max_time) for i in range(args.games)]
+    pool = Pool(args.processes)
+    # Position hash --> {(source, destination): total weight of the games it
+    # was played in}
+    positions = {}
+    finished = 0
+    failed = 0
+    for winners, opening, error in pool.imap_unordered(self_play, jobs):
+        finished += 1
+        if error != None:
+            failed += 1
+            print "\rGame failed:", error
+        sys.stdout.write("\r%d/%d" % (finished, len(jobs)))
+        sys.stdout.flush()
+        # Learn from both sides, trusting the moves of the winners most
+        for key, source, destination, number in opening:
+            moves = positions.setdefault(key, {})
+            moves[(source, destination)] = moves.get((source, destination), 0) +\
+                    result_weight(number, winners)
+    pool.close()
+    pool.join()
+    path = book_path(args.players, args.directory)
+    save(path, args.players, positions)
+    print "\rWrote", path + ":", len(positions), "positions"
+    if failed:
+        print failed, "of", len(jobs), "games failed"
@@ -2,6 +2,7 @@
 
 import sys
 from diamond import board, Network, screen
+from protocol import ProtocolError
 from socket import *
 
 def start_client(s, port, ai):
@@ -9,67 +10,90 @@ def start_client(s, port, ai):
     s.connect((host, port))
     handle_socket(s, ai)
 
+def start_watching(s, port, number):
+    host = "localhost"
+    s.connect((host, port))
+    watch_socket(s, number)
+
 def handle_socket(s, ai):
-    # Message length is 5
-    msg_len = 5
-    # Have a greeting to send to the client
-    greeting = "hello"
-    # Send the server the greeting
-    s.sendall(greeting)
-    # Receive a greeting from the server
-    data = s.recv(msg_len)
-    # If the client did not greet correctly
-    if not data == greeting:
+    # Create the network object for the game; the server says which
+    # player we are
+    net = Network(s, 0)
+    # Greet the server, saying whether a human or an AI is playing here. It
+    # may keep us waiting until another client joins the game
+    print "Waiting for a game"
+    try:
+        version, seat, ais = net.handshake(ai != -1)
+    except ProtocolError as e:
         s.close()
-        print "Disconnected from server"
+        print "Disconnected from server:", e
         return
-    # Receive whether a human or an AI is playing
-    data = s.recv(msg_len)
-    # And tell the server the same
-    if ai == -1:
-        s.sendall("human")
-    else:
-        s.sendall("is_ai")
-    b = None
     # Build the board with the information received
-    if data == "human":
-        if ai == -1:
-            b = board(2, [False, False], [0, 0])
-        else:
-            b = board(2, [False, True], [0, ai])
-    elif data == "is_ai":
-        if ai == -1:
-            b = board(2, [True, False], [0, 0])
-        else:
-            b = board(2, [True, True], [0, ai])
+    difficulties = [0] * len(ais)
+    if ai != -1:
+        ais[seat - 1] = True
+        difficulties[seat - 1] = ai
     else:
-        s.close()
-        print "Disconnected from server"
-        return
-    # Create the network object for the game
-    net = Network(s, 2) # player 2
+        ais[seat - 1] = False
+    b = board(len(ais), ais, difficulties)
     # Then create a new diamond game
     game = screen(b, 450, 1000, net)
     game.mainloop()
     # Close the socket when finished
-    s.close()
+    if net.socket != None:
+        net.socket.close()
+    print "Disconnected from server"
+
+# Watch a game on the server, printing every move made in it
+def watch_socket(s, number):
+    net = Network(s, 0)
+    try:
+        players, turn, moves, contents = net.watch(number)
+    except ProtocolError as e:
+        s.close()
+        print "Disconnected from server:", e
+        return
+    # Nobody plays on this board; it is only kept up to date
+    b = board(players, [False] * players, [0] * players)
+    b.set_state(contents, turn)
+    print "Watching game", number, "after", moves, "moves"
+    while net.socket != None:
+        net.poll(1.0)
+        if net.snapshot != None:
+            players, turn, moves, contents = net.snapshot
+            net.snapshot = None
+            b.set_state(contents, turn)
+            print "Caught up after", moves, "moves"
+        while net.moves:
+            path = net.moves.popleft()
+            number = b.curPlayer.number
+            b.make_move(b.cells[path[0]], b.cells[path[-1]])
+            moves += 1
+            print "Move", str(moves) + ": player", number, "from", path[0], "to", path[-1]
+            if b.winners():
+                print "Player", b.winners()[0], "won"
     print "Disconnected from server"
 
 if __name__ == '__main__':
     # Get and check arguments
     argc, argv = len(sys.argv), sys.argv
-    if argc != 2 and argc != 3:
+    if argc < 2 or argc > 4 or (argc == 4) != (argc > 2 and argv[2] == "watch"):
         print "Usage: ./client.py <port> [<AI>]"
+        print "       ./client.py <port> watch <game>"
         sys.exit(1)
     # Create the socket
     s = socket()
     try:
-        # Handles optional AI argument
-        ai = -1
-        if argc == 3:
-            ai = int(argv[2])
-        # Start the client
-        start_client(s, int(argv[1]), ai)
+        # Watch a game instead of playing one
+        if argc == 4:
+            start_watching(s, int(argv[1]), int(argv[3]))
+        else:
+            # Handles optional AI argument
+            ai = -1
+            if argc == 3:
+                ai = int(argv[2])
+            # Start the client
+            start_client(s, int(argv[1]), ai)
     # If user Ctrl-C-ed out, exit cleanly
     except KeyboardInterrupt:
         print "Bye"
@@ -1,11 +1,30 @@
 #!/usr/bin/env python
 
-import pygame
-from pygame.locals import *
 import ai
 from ai import AI
+from bitboard import get_tables, bitboard
+from bitboard import zobrist_pieces, zobrist_turn, zobrist_hash
 import sys
-from threading import Thread
+import errno
+import select
+from socket import error as socket_error
+from threading import Thread, Condition
+from collections import OrderedDict, deque
+import protocol
+import savegame
+import os
+from time import time
+
+# pygame is only imported once a screen is made (see load_pygame), so that
+# games between AIs can be run without a display (see run_game)
+pygame = None
+
+# Import pygame the first time it is needed
+def load_pygame():
+    global pygame
+    if pygame == None:
+        import pygame
+    return pygame
 
 # Instantiate AI objects for each AI player
 def get_AIs(AIs, difficulties):
@@ -36,8 +55,16 @@ class board:
             print "Badly formatted init: please specifiy either 2 players or 3 players."
         # Keep track of move history
         self.moves = []
-        # Dictionary of point coordinates to objects
-        self.pointPositions={}
+        # Layout of the board, shared by every board with this many players
+        self.tables=get_tables(self.numPlayers)
+        # Points in index order, and a dictionary of point coordinates to objects
+        self.cells=[point(pos[0],pos[1]) for pos in self.tables.positions]
+        self.pointPositions=dict(zip(self.tables.positions,self.cells))
+        #connect neighboring points
+        cells=self.cells
+        for i in range(0,len(cells)):
+            cells[i].index=i
+            cells[i].neighbors=dict([(word,cells[j]) for word,j in self.tables.directed[i]])
         self.hexagon=hexagon(self)
         if self.numPlayers==2:
             #define players
@@ -81,56 +108,28 @@ class board:
         self.triangles=[self.top,self.bottom,self.upperLeft,self.upperRight,self.lowerLeft,self.lowerRight]
         for triangle in self.triangles:
             if triangle.inPlay:
-                for point in triangle.points:
-                    point.contents=triangle.startPlayer.number
+                for curPoint in triangle.points:
+                    curPoint.contents=triangle.startPlayer.number
         
-        #handle the point list, position-->point dictionary, and connections
-        self.allPoints=list(self.hexagon.points)
-        for tri in self.triangles:
-            self.allPoints+=tri.points
-        #connect inner corners of triangles
-        if self.numPlayers==2:
-            self.pointPositions[self.upperRight.p00.pos]=self.top.p33
-            self.upperRight.p00=self.top.p33
-            self.pointPositions[self.upperLeft.p03.pos]=self.top.p30
-            self.upperLeft.p03=self.top.p30
-            self.pointPositions[self.lowerLeft.p33.pos]=self.bottom.p00
-            self.lowerLeft.p33=self.bottom.p00
-            self.pointPositions[self.lowerRight.p30.pos]=self.bottom.p03
-            self.lowerRight.p30=self.bottom.p03
-            self.pointPositions[self.lowerLeft.p00.pos]=self.upperLeft.p30
-            self.lowerLeft.p00=self.upperLeft.p30
-            self.pointPositions[self.lowerRight.p00.pos]=self.upperRight.p30
-            self.lowerRight.p00=self.upperRight.p30
-        if self.numPlayers==3:
-            self.pointPositions[self.upperRight.p00.pos]=self.top.p33
-            self.upperRight.p00=self.top.p33
-            self.pointPositions[self.upperRight.p30.pos]=self.lowerRight.p00
-            self.upperRight.p30=self.lowerRight.p00
-            self.pointPositions[self.bottom.p03.pos]=self.lowerRight.p30
-            self.bottom.p03=self.lowerRight.p30
-            self.pointPositions[self.bottom.p00.pos]=self.lowerLeft.p33
-            self.bottom.p00=self.lowerLeft.p33
-            self.pointPositions[self.upperLeft.p30.pos]=self.lowerLeft.p00
-            self.upperLeft.p30=self.lowerLeft.p00
-            self.pointPositions[self.upperLeft.p03.pos]=self.top.p30
-            self.upperLeft.p03=self.top.p30
-        #connect neighboring points
-        for pos in self.pointPositions:
-                curPoint=self.pointPositions[pos]
-                x=pos[0]
-                y=pos[1]
-                upLeft=(x-20,y-34)
-                upRight=(x+20,y-34)
-                left=(x-40,y)
-                right=(x+40,y)
-                downLeft=(x-20,y+34)
-                downRight=(x+20,y+34)
-                dirs=[upLeft,upRight,left,right,downLeft,downRight]
-                dirWords=["up left","up right","left","right","down left","down right"]
-                for i in range(0,6):
-                    if dirs[i] in self.pointPositions:
-                        curPoint.neighbors[dirWords[i]]=self.pointPositions[dirs[i]]
+        self.allPoints=list(self.cells)
+        #mirror the contents of the points in a bitboard for the AI
+        self.bits=bitboard(self.tables,self.numPlayers)
+        for triangle in self.triangles:
+            if triangle.inPlay:
+                self.bits.fill(triangle.mask,triangle.startPlayer.number)
+        #hash of the position, kept up to date as moves are made
+        self.hash=zobrist_hash(self.bits,self.curPlayer.number)
+        #each player's pieces, by player number (see get_pieces)
+        self.pieces=[()]*(self.numPlayers+1)
+        for curPlayer in self.players:
+            self.pieces[curPlayer.number]=tuple([self.cells[i] for i in self.bits.pieces(curPlayer.number)])
+        #sum of the scores of each player's pieces (see AI.evaluate),
+        #kept up to date as moves are made
+        self.progress=[0]*(self.numPlayers+1)
+        for curPlayer in self.players:
+            number=curPlayer.number
+            for i in self.bits.pieces(number):
+                self.progress[number]+=self.tables.scores[number][i]
 
     def getNearestPoint(self,pos):
         clickX=pos[0]
@@ -161,11 +160,50 @@ class board:
     def get_point(self, pos):
         return self.pointPositions[(pos[0], pos[1])]
                 
-    # Get all pieces belonging to the given player
+    # Get all pieces belonging to the given player. This is the board's own
+    # record of them, which is replaced (never changed) when a piece moves,
+    # so it is safe to keep iterating over it while moves are made
     def get_pieces(self, player):
-        return filter(lambda point: point.contents == player.number, self.allPoints)
+        return self.pieces[player.number]
+
+    # Get the points a piece could pass through to make a move, from the
+    # source to the destination (just the two if it is a single step)
+    def get_path(self, source, destination):
+        path = self.bits.paths(source.index).get(destination.index)
+        if path == None:
+            return []
+        return [self.cells[i] for i in path]
+
+    # Set what a point holds, keeping the bitboard up to date
+    def set_contents(self, point, contents):
+        self.hash ^= zobrist_pieces[point.contents][point.index]
+        self.hash ^= zobrist_pieces[contents][point.index]
+        self.progress[point.contents] -= self.tables.scores[point.contents][point.index]
+        self.progress[contents] += self.tables.scores[contents][point.index]
+        if point.contents != 0:
+            self.pieces[point.contents] = tuple([p for p in self.pieces[point.contents] if p != point])
+        if contents != 0:
+            self.pieces[contents] += (point,)
+        point.contents = contents
+        self.bits.place(point.index, contents)
 
-    # Make a move given source and destination points
+    # Put the given contents on every point (in index order) and make it the
+    # given player's turn, keeping the hash and everything else up to date
+    def set_state(self, contents, turn):
+        for i in range(len(self.cells)):
+            if self.cells[i].contents != contents[i]:
+                self.set_contents(self.cells[i], contents[i])
+        self.hash ^= zobrist_turn[self.curPlayer.number]
+        self.curPlayer = self.players[turn - 1]
+        self.hash ^= zobrist_turn[self.curPlayer.number]
+
+    # Get the numbers of all players whose end triangle is full
+    def winners(self):
+        return [p.number for p in self.players
+                if self.bits.fills(p.number, p.endTri.mask)]
+
+    # Make a move given source and destination points.
+    # Returns an undo record for unmake_move, or False if the move can't be made
     def make_move(self, source, destination):
         # If coordinates were passed instead of objects, get the objects
         if type(source) == tuple and type(destination) == tuple:
@@ -174,19 +212,66 @@ class board:
         # Make sure move can be made
         if source.contents == 0 or destination.contents != 0:
             return False
+        # Remember what is needed to take the move back
+        undo = (source, destination, self.curPlayer, self.hash,
+                self.pieces[source.contents])
         # Move the piece to the empty space
         destination.contents = source.contents
         source.contents = 0
+        number = self.bits.move(source.index, destination.index)
+        self.hash ^= zobrist_pieces[number][source.index]
+        self.hash ^= zobrist_pieces[number][destination.index]
+        scores = self.tables.scores[number]
+        self.progress[number] += scores[destination.index] - scores[source.index]
+        pieces = list(self.pieces[number])
+        pieces[pieces.index(source)] = destination
+        self.pieces[number] = tuple(pieces)
         # Keep the move in the move history
         self.moves.append(((source.xPos, source.yPos),
                           (destination.xPos, destination.yPos)))
         # Change turn
         self.passTurn()
-        return True
+        return undo
+
+    # Take back the move that returned the given undo record.
+    # Moves must be taken back in the reverse order they were made
+    def unmake_move(self, undo):
+        source, destination, player, hash, pieces = undo
+        # Move the piece back to where it came from
+        source.contents = destination.contents
+        destination.contents = 0
+        number = self.bits.move(destination.index, source.index)
+        scores = self.tables.scores[number]
+        self.progress[number] += scores[source.index] - scores[destination.index]
+        self.pieces[number] = pieces
+        # Forget the move and give the turn back
+        self.moves.pop()
+        self.curPlayer = player
+        self.hash = hash
+
+    # Make a copy of the board with the same players' AIs, for an AI to
+    # search on while this board is being drawn (see AI.think)
+    def snapshot(self):
+        copy = board(self.numPlayers, [False] * self.numPlayers, self.difficulties)
+        copy.AIs = list(self.AIs)
+        for i in range(self.numPlayers):
+            copy.players[i].AI = self.players[i].AI
+            copy.players[i].remote = self.players[i].remote
+        for i in range(len(self.cells)):
+            if copy.cells[i].contents != self.cells[i].contents:
+                copy.set_contents(copy.cells[i], self.cells[i].contents)
+        # Keep the pieces in the same order, so the AI picks the same moves
+        copy.pieces = [tuple([copy.cells[p.index] for p in pieces]) for pieces in self.pieces]
+        copy.curPlayer = copy.players[self.curPlayer.number - 1]
+        copy.hash = self.hash
+        copy.moves = list(self.moves)
+        return copy
 
     # Pass a player's turn
     def passTurn(self):
+        self.hash ^= zobrist_turn[self.curPlayer.number]
         self.curPlayer = self.players[self.curPlayer.number % self.numPlayers]
+        self.hash ^= zobrist_turn[self.curPlayer.number]
       
     def AIMove(self, number):
         # Run the current player's AI
@@ -198,49 +283,20 @@ class triangleCorner:
         self.orientation=orientation
         self.inPlay=inPlay#True if it's one player's start and another's end, False otherwise
         self.startPlayer=startPlayer
-        self.points=[]
+        #the triangle's points row by row, shared with the board and neighboring triangles
+        self.points=[board.cells[i] for i in board.tables.triangles[orientation]]
         #mapping from tuple positions (x,y) to point instances
-        self.pointPositions={}
-        #offsets of self.p00, the leftmost point of the topmost row of the triangle.
-        offsets={"top":(220,34),"upper left":(40,136),"upper right":(280,136),"lower left":(100,238),"lower right":(340,238),"bottom":(160,340)}
-        if self.orientation in ["top","lower left","lower right"]:
-            width=[1,2,3,4]#widths of the rows of the hexagon
-            perRowXOffset=-20 #bottom left corner is left of top corner
-        else:
-            width=[4,3,2,1]
-            perRowXOffset=20 #bottom corner is right of top left corner
-        for y in range(0,4):
-            for x in range(0,width[y]):
-                xPos=offsets[self.orientation][0]+perRowXOffset*y+40*x
-                yPos=offsets[self.orientation][1]+34*y
-                call="self.p"+str(y)+str(x)+"=point("+str(xPos)+","+str(yPos)+")"
-                exec(call)
-                addPoint="self.points.append(self.p"+str(y)+str(x)+")"
-                exec(addPoint)
-                self.pointPositions[(xPos,yPos)]=eval("self.p"+str(y)+str(x))
-                self.board.pointPositions[(xPos,yPos)]=eval("self.p"+str(y)+str(x))
+        self.pointPositions=dict((p.pos,p) for p in self.points)
+        #bitboard mask of the triangle's points
+        self.mask=board.tables.triangle_masks[orientation]
+        #the point at the outer corner of the triangle
+        self.tip=board.cells[board.tables.tips[orientation]]
 
 class hexagon:
     def __init__(self,board):
         self.board=board
-        #adjacent points have a y separation of 0 pixels and an x separation of 40 pixels,
-        #or an x separation of 20 and a y separation of 34.
-        #the leftmost point of the top row is at (200,160): 200 from left, 160 from top.
-        width=[3,4,5,4,3]#widths of the rows of the hexagon
-        xOffset=[180,160,140,160,180]
-        self.points=[]
-        self.pointPositions={}
-        for y in range(0,5):
-            for x in range(0,width[y]):
-                xPos=xOffset[y]+40*x
-                yPos=170+34*y
-                call="self.p"+str(y)+str(x)+"=point("+str(xPos)+","+str(yPos)+")"
-                exec(call)
-                addPoint="self.points.append(self.p"+str(y)+str(x)+")"
-                exec(addPoint)
-                self.pointPositions[(xPos,yPos)]=eval("self.p"+str(y)+str(x))
-                self.board.pointPositions[(xPos,yPos)]=eval("self.p"+str(y)+str(x))
-         
+        self.points=[board.pointPositions[pos] for pos in board.tables.hexagon]
+        self.pointPositions=dict((p.pos,p) for p in self.points)
 
 class point: #a single position which can hold a piece
     def __init__(self,xPos,yPos,contents=0):
@@ -277,16 +333,16 @@ class player:
     def useInput(self, event, board, paused):
         # Only allow input of game is running
         if not paused:
-            if event.type==KEYDOWN and event.key==K_RETURN:
+            if event.type==pygame.KEYDOWN and event.key==pygame.K_RETURN:
                 if len(self.curMoveChain)>=2: #need at least a start and an end
                     # Actually make the move
                     board.make_move(self.curMoveChain[0], self.curMoveChain[-1])
                     self.curMoveChain = [] # Empty the move chain
                     return True # Notify the caller that a move was made
-            elif event.type==KEYDOWN and event.key==K_BACKSPACE:
+            elif event.type==pygame.KEYDOWN and event.key==pygame.K_BACKSPACE:
                 if len(self.curMoveChain)>0:
                     self.curMoveChain=self.curMoveChain[:-1]
-            elif event.type==MOUSEBUTTONDOWN:
+            elif event.type==pygame.MOUSEBUTTONDOWN:
                 pos=event.pos
                 point=board.getNearestPoint(pos)
                 if not point:
@@ -306,47 +362,175 @@ class player:
         #If you press Enter without having selected a valid move, nothing will happen.
 
 class Network:
-    def __init__(self, socket, player_num):
+    def __init__(self, socket, player_num, read_timeout=protocol.read_timeout,
+            heartbeat_interval=protocol.heartbeat_interval):
         # Socket to read to and write from
         self.socket = socket
         # Local player's player number
         self.number = player_num
-        # Message length to be receiving
-        self.mess_len = len("0xo,0yo:0xt,0yt")
-    
-    # If something fails at any point here, nothing can be done, so let it
-    def get_turn(self, board):
-        # Receive a move from the socket
-        msg = self.socket.recv(self.mess_len)
-        # If too-short message received
-        if len(msg) < self.mess_len:
-            print "Opponent exited."
-            # Close socket and set to none for screen to see
-            self.socket.close()
-            self.socket = None
+        # Version of the protocol agreed with the other side
+        self.version = protocol.max_version
+        # Splits what is received into messages, and the messages received
+        # but not handled yet
+        self.reader = protocol.FrameReader()
+        self.messages = deque()
+        # Paths of the moves received but not played yet
+        self.moves = deque()
+        # Latest board sent to us as a spectator, if it has not been shown
+        # yet (see protocol.decode_snapshot)
+        self.snapshot = None
+        # Bytes waiting to be sent
+        self.outbox = ""
+        # Seconds of silence before the other side is taken to be gone, and
+        # before a PING is sent to show we are still here
+        self.read_timeout = read_timeout
+        self.heartbeat_interval = heartbeat_interval
+        # When something was last received and last sent
+        self.last_received = time()
+        self.last_sent = time()
+
+    # Wait for the next message from the other side, as (type, contents).
+    # Returns None if the other side hung up. Only used before the game
+    # starts; after that, see poll
+    def read_message(self):
+        while not self.messages:
+            data = self.socket.recv(4096)
+            if not data:
+                return None
+            self.messages.extend(self.reader.feed(data))
+        return self.messages.popleft()
+
+    # Say hello to the server and find out which seat we have been given.
+    # Returns (version, seat, whether an AI plays in each seat).
+    # Raises protocol.ProtocolError if the server won't give us a game.
+    # The server may keep us waiting for an opponent, pinging us meanwhile
+    def handshake(self, is_ai, seat=0):
+        self.socket.sendall(protocol.hello_frame(is_ai, seat))
+        message = self.read_message()
+        while message != None and message[0] == protocol.PING:
+            message = self.read_message()
+        if message == None:
+            raise protocol.ProtocolError("Server hung up")
+        if message[0] == protocol.ERROR:
+            raise protocol.ProtocolError(message[1])
+        if message[0] != protocol.WELCOME:
+            raise protocol.ProtocolError("Expected a welcome")
+        self.version, self.number, ais = protocol.decode_welcome(message[1])
+        self.last_received = time()
+        return self.version, self.number, ais
+
+    # Ask the server to let us watch a game. Returns the board as it is now
+    # (see protocol.decode_snapshot); the moves made after it arrive like
+    # any others. Raises protocol.ProtocolError if we can't watch the game
+    def watch(self, number):
+        self.socket.sendall(protocol.watch_frame(number))
+        message = self.read_message()
+        if message == None:
+            raise protocol.ProtocolError("Server hung up")
+        if message[0] == protocol.ERROR:
+            raise protocol.ProtocolError(message[1])
+        if message[0] != protocol.SNAPSHOT:
+            raise protocol.ProtocolError("Expected a snapshot")
+        self.last_received = time()
+        return protocol.decode_snapshot(message[1])
+
+    # Close the socket and set it to None for the screen to see
+    def hang_up(self, reason):
+        print reason
+        self.socket.close()
+        self.socket = None
+
+    """
+    Send and receive whatever can be without waiting, for at most timeout
+    seconds if given. Moves that arrive are kept in self.moves. Hangs up if
+    the other side has gone away, broken the protocol or been silent for too
+    long, and sends a PING if we have been.
+    """
+    def poll(self, timeout=0):
+        if self.socket == None:
+            return
+        self.socket.setblocking(0)
+        writers = []
+        if self.outbox:
+            writers = [self.socket]
+        try:
+            readable, writable, broken = select.select([self.socket], writers, [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        now = time()
+        if readable:
+            try:
+                data = self.socket.recv(4096)
+            except socket_error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.hang_up("Lost connection to opponent.")
+                    return
+            else:
+                if not data:
+                    self.hang_up("Opponent exited.")
+                    return
+                self.last_received = now
+                try:
+                    self.messages.extend(self.reader.feed(data))
+                except protocol.ProtocolError as e:
+                    self.hang_up("Bad message from opponent: " + str(e))
+                    return
+        # Handle every message received, including any that came with the
+        # handshake
+        while self.messages:
+            kind, payload = self.messages.popleft()
+            try:
+                if kind == protocol.MOVE:
+                    self.moves.append(protocol.decode_move(payload))
+                elif kind == protocol.SNAPSHOT:
+                    # We fell behind, so start again from the board as it is
+                    self.snapshot = protocol.decode_snapshot(payload)
+                    self.moves.clear()
+                elif kind == protocol.ERROR:
+                    self.hang_up("Opponent stopped the game: " + payload)
+                    return
+                elif kind != protocol.PING:
+                    self.hang_up("Unexpected message from opponent.")
+                    return
+            except protocol.ProtocolError as e:
+                self.hang_up("Bad message from opponent: " + str(e))
+                return
+        if writable:
+            try:
+                sent = self.socket.send(self.outbox)
+            except socket_error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.hang_up("Lost connection to opponent.")
+                    return
+            else:
+                self.outbox = self.outbox[sent:]
+                self.last_sent = now
+        if now - self.last_received > self.read_timeout:
+            self.hang_up("Opponent timed out.")
             return
-        # Get parts out of message
-        parts = msg.split(":")
-        origin = parts[0].split(",")
-        target = parts[1].split(",")
-        # Then convert them to ints
-        origin[0] = int(origin[0])
-        origin[1] = int(origin[1])
-        target[0] = int(target[0])
-        target[1] = int(target[1])
-        # Get the source and destination points
-        source = board.get_point(origin)
-        destination = board.get_point(target)
-        # Then make the move
-        board.make_move(source, destination)
-
-    def send_turn(self, move):
-        # Turn the move into a string and pad numbers
-        msg = "{0:03d},{1:03d}:{2:03d},{3:03d}".format(\
-                move[0][0], move[0][1],\
-                move[1][0], move[1][1])
-        # Send the message over the socket
-        self.socket.sendall(msg)
+        if not self.outbox and now - self.last_sent >= self.heartbeat_interval:
+            self.send(protocol.ping_frame())
+
+    # Queue bytes to send, and send what can be sent straight away
+    def send(self, data):
+        self.outbox += data
+        self.poll()
+
+    # Play the next move received, if one has arrived.
+    # Returns whether a move was played
+    def get_turn(self, board):
+        self.poll()
+        if not self.moves:
+            return False
+        path = self.moves.popleft()
+        # Make the move from the start of the path to the end
+        return board.make_move(board.cells[path[0]], board.cells[path[-1]]) != False
+
+    def send_turn(self, board, move):
+        # Send the move over the socket, with the path the piece took
+        self.send(protocol.move_frame(protocol.move_path(board, move)))
 
 class screen: #the pygame screen and high-level "running the game" stuff
     def __init__(self,board,xDim,yDim,network):
@@ -359,6 +543,7 @@ class screen: #the pygame screen and high-level "running the game" stuff
         # Graphics related things
         self.xDim=xDim
         self.yDim=yDim
+        load_pygame()
         pygame.init()
         self.background=pygame.image.load("blank background.png")
         self.gameScreen=pygame.display.set_mode((xDim,yDim),0,32)
@@ -367,15 +552,32 @@ class screen: #the pygame screen and high-level "running the game" stuff
         self.clock=pygame.time.Clock()
         self.fps=36
         self.font = pygame.font.SysFont('Arial', 25)
+        self.textCache=OrderedDict() #rendered text, by (text, colour), least recently used first
+        self.textCacheSize=64 #most pieces of text to keep rendered
         self.instructions=["Click the piece you want to move,","then each space in its path.","Press Enter when you are finished.","Press Backspace to undo a click."]
-        for i in range(0,len(self.instructions)):
-            self.gameScreen.blit(self.font.render(self.instructions[i], True, (0,0,255)), (20, 450+30*i))
+        self.colors={0:(255,255,255),1:(255,0,0),2:(0,255,0),3:(0,0,255)} #colour of each player's pieces
+        # What is on the screen, so that only what changes is drawn again
+        self.boardLayer=self.build_board_layer() #the board without pieces or messages
+        self.redrawAll=True #whether the whole screen needs drawing
+        self.drawnHash=None #hash of the position the pieces were drawn for
+        self.drawnContents=[] #contents of each point when drawn
+        self.drawnChain=() #indices of the points in the move chain when drawn
+        self.drawnText={} #(text, rect) of each message when drawn, by name
+        self.displayClock=pygame.time.Clock() #caps the display's frame rate
         self.running=True #the game has not been quit
         self.playing=True # The game has not been won
         self.winMessage=""#nobody has won yet
         self.paused = False #Whether or not the game is paused
-        self.turnTimeTaken = 0 #Time taken for the current turn in ms
+        self.turnStart = time() #When the current turn started
         self.maximumTurnTime = 10000 #Maximum time allowed per turn in ms
+        # Hands turns between the threads: whoever makes a move or stops the
+        # game notifies it, and the update thread sleeps on it until then
+        self.turnChanged = Condition()
+        self.thinking = None # Move an AI is working out (see AI.think)
+        self.pondering = None # Search on the opponent's time (see AI.ponder_on)
+        self.thinkingMessage = "" # How far the AI has got
+        self.savePath = savegame.default_path # Where the game is saved
+        self.journal = None # Once the game has been saved, every turn is added to the save
 
     def mainloop(self):
         try:
@@ -386,11 +588,11 @@ class screen: #the pygame screen and high-level "running the game" stuff
             self.display()
         except KeyboardInterrupt:
             # Stop the game if interrupted
-            self.running = False
+            self.stop()
             print "\nBye"
         except:
             # Stop the game if an error happens
-            self.running = False
+            self.stop()
             # Raise the exception
             raise
         # Exit the game at the end of the loop
@@ -400,58 +602,158 @@ class screen: #the pygame screen and high-level "running the game" stuff
     def update(self):
         # Make sure the game is running and players are playing
         while self.running and self.playing:
-            # Exit if network closes
-            if self.network != None and self.network.socket == None:
-                return
+            # Keep the network going, and exit if it closes
+            if self.network != None:
+                self.network.poll()
+                if self.network.socket == None:
+                    return
             self.play_turn(self.board)
+            self.autosave()
             self.checkWin()
             # The turn timer does not work for networked games
             if self.network == None:
                 #Handle time outs during player turns
-                self.turnTimeTaken += self.clock.get_time() #Increment the turn timer
-                if self.turnTimeTaken > self.maximumTurnTime:
+                if self.turn_time() > self.maximumTurnTime:
                     self.board.passTurn()
-                    self.turnTimeTaken = 0
+                    self.autosave(True)
+                    self.stop_pondering()
+                    self.end_turn()
             # Maintain update rate to FPS
             self.clock.tick(self.fps)
 
     # Display updating, handles display and input
     def display(self):
-        curr_player = self.board.curPlayer
         while self.running:
             self.drawScreen()
             self.getInput(self.board)
+            # Nothing on the screen needs drawing more often than this
+            self.displayClock.tick(self.fps)
+
+    # Time taken for the current turn in ms
+    def turn_time(self):
+        return int((time() - self.turnStart) * 1000)
+
+    # Start timing the next turn and wake up anything waiting for a move
+    def end_turn(self):
+        with self.turnChanged:
+            self.turnStart = time()
+            self.turnChanged.notify_all()
 
+    # Stop the game and wake up anything waiting for a move
+    def stop(self):
+        with self.turnChanged:
+            self.running = False
+            if self.thinking != None:
+                self.thinking.cancel()
+            if self.pondering != None:
+                self.pondering.cancel()
+            # Every turn is already on disk, so the save can just be closed
+            if self.journal != None:
+                self.journal.close()
+                self.journal = None
+            self.turnChanged.notify_all()
+
+    # Show how far the AI's search has got (called from the AI's thread)
+    def show_progress(self, depth, nodes, seconds, move):
+        self.thinkingMessage = "AI thinking: depth " + str(depth) + ", " +\
+                str(nodes) + " positions"
+
+    # Sleep until the given player's turn is over or the game stops, or for
+    # at most timeout seconds if given
+    def wait_for_move(self, player, timeout=None):
+        with self.turnChanged:
+            if timeout != None:
+                deadline = time() + timeout
+            while self.running and self.board.curPlayer == player:
+                if timeout == None:
+                    self.turnChanged.wait()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        return
+                    self.turnChanged.wait(remaining)
+
+    # Let the player after the current one search on the current player's
+    # time, if they are a local AI that ponders
+    def start_pondering(self, board):
+        following = board.players[board.curPlayer.number % board.numPlayers]
+        if following.AI and not following.remote:
+            self.pondering = following.AI.ponder_on(board)
+
+    # Stop pondering and wait for the AI to be free again
+    def stop_pondering(self):
+        if self.pondering != None:
+            self.pondering.cancel()
+            self.pondering.result()
+            self.pondering = None
+
+    # Play one tick of the current player's turn. Turns that depend on
+    # someone else (a human, or the network) are only checked on, so that
+    # the update loop keeps going until they are over
     def play_turn(self, board):
         player = board.curPlayer
+        passed = False # Whether an AI passed, having no move to make
+        # An AI can't ponder on another AI's time, as it would slow it down
+        if (player.remote or not player.AI) and self.pondering == None:
+            self.start_pondering(board)
         # If the current player is not remote
         if not player.remote:
             if player.AI: # AI
-                board.AIMove(player.number)
+                self.stop_pondering()
+                # Let the AI think on a copy of the board in the background
+                # and only play the move it comes back with
+                self.thinking = player.AI.think(board, self.show_progress)
+                if not self.running:
+                    self.thinking.cancel()
+                # Keep the network going while it thinks
+                while not self.thinking.done():
+                    self.thinking.finished.wait(1.0 / self.fps)
+                    if self.network != None:
+                        self.network.poll()
+                move = self.thinking.result()
+                passed = self.thinking.passed
+                self.thinking = None
+                self.thinkingMessage = ""
+                if move != None and self.running:
+                    board.make_move(move[0], move[1])
+                elif passed and self.running:
+                    board.passTurn()
+                    self.autosave(True)
                 # And end of turn, reset timer
-                self.turnTimeTaken = 0
+                self.end_turn()
             else: # Human
-                self.getInput(board)
-        # Otherwise get the turn from the network
-        else:
-            self.network.get_turn(board)
-        # If the game is networked and the player is local
-        if self.network != None and not player.remote:
-            # Wait until a move was made
-            while board.curPlayer == player:
-                pass
-            # Then we need to send the remote player the move
-            self.network.send_turn(board.moves[-1])
+                # The display thread takes their input, so wait for it to
+                # make the move or for the turn to run out
+                if self.network == None:
+                    timeout = max(self.maximumTurnTime - self.turn_time(), 0) / 1000.0
+                else:
+                    # Come back every tick to keep the network going
+                    timeout = 1.0 / self.fps
+                self.wait_for_move(player, timeout)
+        # Otherwise play the turn from the network, if it has arrived
+        elif self.network.get_turn(board):
+            self.end_turn()
+        # Nothing more to do until the turn is over
+        if board.curPlayer == player:
+            return
+        self.stop_pondering()
+        # If the game is networked and the player is local, we need to send
+        # the remote player the move
+        if self.network != None and not player.remote and not passed:
+            self.network.send_turn(board, board.moves[-1])
 
     def getInput(self,board):
         events = pygame.event.get()
         for event in events:
-            if event.type == QUIT:
-                self.running=False
+            if event.type == pygame.QUIT:
                 self.playing=False
+                self.stop()
                 break
+            # The window was uncovered, so everything has to be drawn again
+            if event.type == pygame.VIDEOEXPOSE:
+                self.redrawAll = True
             #Save/load the game
-            if event.type == KEYUP:
+            if event.type == pygame.KEYUP:
                 if event.key == pygame.K_s:
                     self.saveGame()
                 elif event.key == pygame.K_l:
@@ -466,92 +768,191 @@ class screen: #the pygame screen and high-level "running the game" stuff
                         not board.curPlayer.remote:
                     # Handle the input
                     if board.curPlayer.useInput(event, board, self.paused):
-                        # And reset the timer if a move was performed
-                        self.turnTimeTaken = 0
+                        # And reset the timer and hand over the turn if a
+                        # move was performed
+                        self.end_turn()
 
+    # Save the game, and keep adding every turn to the save from now on
+    # (see savegame.py). Called from the display thread, so the journal is
+    # only changed while holding the turn lock
     def saveGame(self):
-        f = open('save.dat', 'w')
-        #First write the current turn
-        f.write(str(self.curPlayer.number) + '\n')
-        boardFunc = getattr(self.board, 'getNearestPoint')
-        for pos in self.board.pointPositions:
-            point = boardFunc(pos)
-            #Save file format for board state: POINT_X POINT_Y POINT_CONTENTS \n
-            f.write(str(pos[0]) + ' ' + str(pos[1]) + ' ' + str(point.contents) + '\n')
-        f.close()
-    
+        with self.turnChanged:
+            if self.journal != None:
+                self.journal.close()
+            self.journal = savegame.Journal(self.savePath, self.board)
+
+    # Add the turns played since the last call to the save, if the game has
+    # been saved. passed says the turn was just passed without a move
+    def autosave(self, passed=False):
+        with self.turnChanged:
+            if self.journal != None:
+                self.journal.record(self.board)
+                if passed:
+                    self.journal.pass_turn()
+
+    # Carry on from the save, or from a save in the old text format if there
+    # is no other
     def loadGame(self):
-        setTurn = False
-        f = open('save.dat', 'r')
-        boardFunc = getattr(self.board, 'getNearestPoint')
-        for line in f:
-            if not setTurn:
-                #Player 1 is located at index 0, etc...
-                self.curPlayer = self.players[int(line) - 1]
-                setTurn = True
-            else:
-                s = line.split(' ')
-                pos = (int(s[0]), int(s[1]))
-                con = int(s[2])
-                point = boardFunc(pos)
-                point.contents = con
+        if os.path.exists(self.savePath):
+            loaded = savegame.load(self.savePath, self.board) != None
+        elif os.path.exists(savegame.legacy_path):
+            loaded = savegame.load_legacy(savegame.legacy_path, self.board)
+        else:
+            loaded = False
+        if not loaded:
+            print "No saved game to load"
+            return
+        # Start saving the loaded game afresh, so its journal does not grow
+        # without end
+        if self.journal != None:
+            self.saveGame()
+        self.end_turn()
 
-    def drawScreen(self):
-        self.gameScreen.fill(self.backgroundColor)
-        colorDict={0:(255,255,255),1:(255,0,0),2:(0,255,0),3:(0,0,255)}
-        for pos in self.board.pointPositions:
-            point=self.board.pointPositions[pos]
-            colorNum=point.contents
-            color=colorDict[colorNum]
-            pygame.draw.circle(self.gameScreen,color,pos,10,0) #piece or empty white circle 
-            pygame.draw.circle(self.gameScreen,(0,0,0),pos,11,1) #black border
-            adjacent=point.neighbors.values()
-            for p in adjacent:
-                pygame.draw.line(self.gameScreen, (0,0,0), point.pos, p.pos, 1)
-        for point in self.board.curPlayer.curMoveChain:
-            pygame.draw.circle(self.gameScreen,(0,0,255),point.pos,12,3) #black border
+    # Get a surface with some text on it in the screen's font, rendering it
+    # only if it has not been rendered recently
+    def renderText(self,text,color):
+        key=(text,color)
+        surface=self.textCache.pop(key,None)
+        if surface==None:
+            surface=self.font.render(text,True,color)
+            if len(self.textCache)>=self.textCacheSize:
+                self.textCache.popitem(last=False) #forget the least recently used
+        self.textCache[key]=surface #now the most recently used
+        return surface
+
+    # Change the font of all text on the screen
+    def setFont(self,font):
+        self.font=font
+        # Text rendered in the old font can't be used any more
+        self.textCache.clear()
+        self.boardLayer=self.build_board_layer()
+        self.redrawAll=True
+
+    # Draw the parts of the screen that never change: the lines between
+    # points, the empty holes and the instructions
+    def build_board_layer(self):
+        layer=pygame.Surface((self.xDim,self.yDim)).convert()
+        layer.fill(self.backgroundColor)
+        cells=self.board.cells
+        for point in cells:
+            for p in point.neighbors.values():
+                if p.index>point.index: #draw each line once
+                    pygame.draw.line(layer,(0,0,0),point.pos,p.pos,1)
+        for point in cells:
+            pygame.draw.circle(layer,self.colors[0],point.pos,10,0) #empty white circle
+            pygame.draw.circle(layer,(0,0,0),point.pos,11,1) #black border
         for i in range(0,len(self.instructions)):
-            self.gameScreen.blit(self.font.render(self.instructions[i], True, (0,0,255)), (20, 450+30*i))
-        self.gameScreen.blit(self.font.render("Current player: "+str(self.board.curPlayer.number), True, (0,0,255)), (20, 10))
-        self.gameScreen.blit(self.font.render(self.winMessage, True, (0,0,255)), (20, 40))
-        self.gameScreen.blit(self.font.render("Time left for current turn: " + str((self.maximumTurnTime - self.turnTimeTaken) / 1000) + " sec", True, (0,0,255)), (20, 570))
+            layer.blit(self.renderText(self.instructions[i],(0,0,255)), (20, 450+30*i))
+        return layer
+
+    # Draw a point over the board layer: its piece, and a highlight if it is
+    # in the move chain. Returns the area of the screen drawn on
+    def drawPoint(self,point,highlighted):
+        rect=pygame.Rect(point.xPos-13,point.yPos-13,27,27)
+        self.gameScreen.blit(self.boardLayer,rect,rect)
+        if point.contents!=0:
+            pygame.draw.circle(self.gameScreen,self.colors[point.contents],point.pos,10,0) #piece
+            pygame.draw.circle(self.gameScreen,(0,0,0),point.pos,11,1) #black border
+        if highlighted:
+            pygame.draw.circle(self.gameScreen,(0,0,255),point.pos,12,3) #move chain highlight
+        return rect
+
+    # Draw a message if it is not already on the screen, rubbing out the
+    # message that was there before. Returns the area of the screen drawn on,
+    # or None if nothing was drawn
+    def drawText(self,name,text,pos):
+        drawn=self.drawnText.get(name)
+        if drawn!=None and drawn[0]==text:
+            return None
+        surface=self.renderText(text,(0,0,255))
+        rect=surface.get_rect(topleft=pos)
+        dirty=rect
+        if drawn!=None:
+            old=drawn[1]
+            self.gameScreen.blit(self.boardLayer,old,old)
+            # Put back any pieces the old message was drawn over, without
+            # touching anything outside it
+            self.gameScreen.set_clip(old)
+            for p in self.board.cells:
+                if old.colliderect((p.xPos-13,p.yPos-13,27,27)):
+                    self.drawPoint(p,p.index in self.drawnChain)
+            self.gameScreen.set_clip(None)
+            dirty=rect.union(old)
+        self.gameScreen.blit(surface,rect)
+        self.drawnText[name]=(text,rect)
+        return dirty
+
+    # Draw whatever has changed since the last frame
+    def drawScreen(self):
+        board=self.board
+        cells=board.cells
+        dirty=[] #areas of the screen that were drawn on
+        if self.redrawAll:
+            self.gameScreen.blit(self.boardLayer,(0,0))
+            self.drawnHash=None
+            self.drawnContents=[0]*len(cells)
+            self.drawnChain=()
+            self.drawnText={}
+            dirty.append(self.gameScreen.get_rect())
+            self.redrawAll=False
+        # Draw the points whose piece or highlight changed
+        chain=tuple([p.index for p in board.curPlayer.curMoveChain])
+        if board.hash!=self.drawnHash or chain!=self.drawnChain:
+            changed=set(chain).symmetric_difference(self.drawnChain)
+            contents=[p.contents for p in cells]
+            for i in range(len(cells)):
+                if contents[i]!=self.drawnContents[i]:
+                    changed.add(i)
+            for i in changed:
+                dirty.append(self.drawPoint(cells[i],i in chain))
+            self.drawnHash=board.hash
+            self.drawnContents=contents
+            self.drawnChain=chain
+        # Draw the messages that changed
         pausemsg = "The game is currently "
         if self.paused:
             pausemsg = pausemsg + "paused"
         else:
             pausemsg = pausemsg + "not paused"
-        self.gameScreen.blit(self.font.render(pausemsg, True, (0,0,255)), (20, 600))
-        pygame.display.flip()
+        messages=[("player","Current player: "+str(board.curPlayer.number),(20, 10)),
+                ("win",self.winMessage,(20, 40)),
+                ("thinking",self.thinkingMessage,(20, 70)),
+                ("timer","Time left for current turn: " + str((self.maximumTurnTime - self.turn_time()) / 1000) + " sec",(20, 570)),
+                ("pause",pausemsg,(20, 600))]
+        for name,text,pos in messages:
+            rect=self.drawText(name,text,pos)
+            if rect!=None:
+                dirty.append(rect)
+        if dirty:
+            pygame.display.update(dirty)
 
     def checkWin(self):
-        p1Win=True
-        p2Win=True
-        for point in self.board.players[0].endTri.points:
-            if point.contents!=1:
-                p1Win=False
-                break
-        for point in self.board.players[1].endTri.points:
-            if point.contents!=2:
-                p2Win=False
-                break
-        if len(self.board.players)==3:
-            p3Win=True
-            for point in self.board.players[2].endTri.points:
-                if point.contents!=3:
-                    p3Win=False
-                    break
+        winners=self.board.winners()
         self.winMessage=""
-        if p1Win:
-            self.winMessage+="Player 1 wins! "
-            self.playing = False
-        if p2Win:
-            self.winMessage+="Player 2 wins! "
-            self.playing = False
-        if len(self.board.players)==3 and p3Win:
-            self.winMessage+="Player 3 wins!"
+        for number in winners:
+            self.winMessage+="Player "+str(number)+" wins! "
             self.playing = False
         
 
+# Play a game between AI players without a screen, for at most max_moves turns.
+# If given, on_move(board, player, seconds) is called after every turn with
+# the player whose turn it was and how long their AI took.
+# Returns the numbers of the players who won (empty if nobody won in time)
+def run_game(board, max_moves=1000, on_move=None):
+    for turn in range(max_moves):
+        player = board.curPlayer
+        if not player.AI:
+            raise ValueError("Player " + str(player.number) +
+                    " is human and can't play without a screen.")
+        start = time()
+        player.AI.ai_player(board)
+        if on_move != None:
+            on_move(board, player, time() - start)
+        winners = board.winners()
+        if winners:
+            return winners
+    return []
+
 # Only call this if the file is run, not imported
 if __name__ == '__main__':
     # Default options
@@ -573,15 +974,15 @@ if __name__ == '__main__':
                     ais[i] = False
                 num_players += 1
         # Set the difficulties passed to the command line
-        if argc == 3:
+        if argc >= 3:
             for i in range(len(argv[2])):
                 num = int(argv[2][i])
-                if 0 <= num <= 3:
+                if 0 <= num <= 4:
                     difficulties[i] = num
                 elif num < 0:
                     difficulties[i] = 0
                 else:
-                    difficulties[i] = 3
+                    difficulties[i] = 4
     # If an int could not be converted correctly, do not worry,
     # as defaults will be used.
     except ValueError:
@@ -591,7 +992,15 @@ if __name__ == '__main__':
         raise
     # Create a board with AI/human players and AI difficulties
     b = board(num_players, ais, difficulties)
+    # Let the AIs think on their opponents' time if asked to
+    if "ponder" in argv[3:]:
+        for p in b.players:
+            if p.AI:
+                p.AI.ponder = True
     game = screen(b, 450, 1000, None)
+    # Save the game after every turn from the start if asked to
+    if "autosave" in argv[3:]:
+        game.saveGame()
     # Run the game loop
     game.mainloop()
     # Quit the display
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+"""
+Endgame tables: for the last few pieces of a player still outside their end
+triangle, the fewest moves needed to fill it.
+
+A table covers the positions where at most a few of the player's pieces are
+outside the end triangle, all of them within a couple of steps of it. The
+distances are found by a breadth-first search back from the full triangle,
+with the player's own pieces as the only ones on the board, and only through
+positions the table covers. They are written to a file once by running this
+module, and the AI reads them through mmap while it plays.
+
+Example: ./endgame.py --players 2 --pieces 3
+"""
+
+import os
+import mmap
+import struct
+from argparse import ArgumentParser
+from bitboard import get_tables, end_triangles, reachable, bit_indices, indices_mask
+
+# Start of every table file, and the version of its format
+magic = "PDEG"
+version = 1
+# magic, version, players, player number, most pieces outside, region size,
+# triangle size; followed by the region and triangle indices (a byte each)
+# and then one distance byte per position
+header_format = "<4sBBBBBB"
+# Distance of a position that can't be finished within the table
+unknown = 255
+# Directory tables are read from when none is given
+default_directory = os.path.dirname(os.path.abspath(__file__))
+
+"""
+Number of ways to choose k things out of n.
+"""
+def choose(n, k):
+    if k < 0 or k > n:
+        return 0
+    result = 1
+    for i in range(k):
+        result = result * (n - i) // (i + 1)
+    return result
+
+"""
+Rank a sorted list of distinct small numbers among all lists of the same
+length (the combinatorial number system), so each gets its own index.
+"""
+def rank_combination(numbers):
+    rank = 0
+    for i in range(len(numbers)):
+        rank += choose(numbers[i], i + 1)
+    return rank
+
+class EndgameTable:
+    def __init__(self, numPlayers, number, pieces, region, triangle, distances=None):
+        self.numPlayers = numPlayers
+        # Player the table is for
+        self.number = number
+        # Most pieces that may be outside the end triangle
+        self.pieces = pieces
+        # Indices outside the end triangle that pieces may be on, and the
+        # indices of the end triangle, both in increasing order
+        self.region = sorted(region)
+        self.triangle = sorted(triangle)
+        self.region_mask = indices_mask(self.region)
+        self.triangle_mask = indices_mask(self.triangle)
+        # Mask of every index the table covers
+        self.domain = self.region_mask | self.triangle_mask
+        # Board index --> position in region or triangle list
+        self.local = {}
+        for i in range(len(self.region)):
+            self.local[self.region[i]] = i
+        for i in range(len(self.triangle)):
+            self.local[self.triangle[i]] = i
+        # Where the positions with k pieces outside start in the table
+        self.offsets = []
+        size = 0
+        for k in range(pieces + 1):
+            self.offsets.append(size)
+            size += choose(len(self.region), k) * choose(len(self.triangle), k)
+        self.size = size
+        # One byte per position: the fewest moves to finish, or unknown
+        if distances == None:
+            distances = bytearray([unknown]) * size
+        self.distances = distances
+
+    """
+    Get the place in the table of a mask of the player's pieces, or None if
+    the table does not cover it.
+    """
+    def rank(self, mask):
+        outside = mask & ~self.triangle_mask
+        if outside & ~self.region_mask:
+            return None
+        outside = bit_indices(outside)
+        holes = bit_indices(self.triangle_mask & ~mask)
+        k = len(outside)
+        if k > self.pieces or len(holes) != k:
+            return None
+        local = self.local
+        return (self.offsets[k] +
+                rank_combination([local[i] for i in outside]) * choose(len(self.triangle), k) +
+                rank_combination([local[i] for i in holes]))
+
+    """
+    Get the fewest moves to finish from a mask of the player's pieces, or
+    None if the table does not know.
+    """
+    def distance(self, mask):
+        rank = self.rank(mask)
+        if rank == None:
+            return None
+        distance = self.distances[rank]
+        # An mmap gives back single characters
+        if type(distance) == str:
+            distance = ord(distance)
+        if distance == unknown:
+            return None
+        return distance
+
+    """
+    Write the table to a file.
+    """
+    def save(self, path):
+        f = open(path, "wb")
+        f.write(struct.pack(header_format, magic, version, self.numPlayers,
+                self.number, self.pieces, len(self.region), len(self.triangle)))
+        f.write(bytearray(self.region))
+        f.write(bytearray(self.triangle))
+        f.write(self.distances)
+        f.close()
+
+"""
+Map a table file into memory and return the table, or None if the file is
+not a table.
+"""
+def load(path):
+    f = open(path, "rb")
+    data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    f.close()
+    start = struct.calcsize(header_format)
+    if len(data) < start:
+        return None
+    header = struct.unpack(header_format, data[:start])
+    if header[0] != magic or header[1] != version:
+        return None
+    numPlayers, number, pieces, region_size, triangle_size = header[2:]
+    region = bytearray(data[start:start + region_size])
+    start += region_size
+    triangle = bytearray(data[start:start + triangle_size])
+    start += triangle_size
+    table = EndgameTable(numPlayers, number, pieces, list(region), list(triangle),
+            bytearray())
+    # Read distances straight from the mapped file
+    table.distances = buffer(data, start, table.size)
+    return table
+
+"""
+Work out the table for one player by searching back from the full end
+triangle. Pieces outside the triangle may be on any index within reach
+steps of it.
+"""
+def generate(numPlayers, number, pieces=3, reach=2):
+    tables = get_tables(numPlayers)
+    triangle = tables.triangles[end_triangles[numPlayers][number]]
+    # Find the region around the triangle, one step further each time
+    near = set(triangle)
+    for i in range(reach):
+        for index in list(near):
+            near.update(tables.steps[index])
+    region = near.difference(triangle)
+    table = EndgameTable(numPlayers, number, pieces, region, triangle)
+    distances = table.distances
+    # Every move can be made backwards too, so the distance from the full
+    # triangle is the distance to it
+    goal = table.triangle_mask
+    distances[table.rank(goal)] = 0
+    # Masks already reached, which is quicker to check than their rank
+    seen = set([goal])
+    outside_mask = ~table.triangle_mask
+    frontier = [goal]
+    distance = 0
+    while frontier:
+        distance += 1
+        following = []
+        for mask in frontier:
+            for piece in bit_indices(mask):
+                for destination in reachable(tables, mask, piece):
+                    if not table.domain >> destination & 1:
+                        continue
+                    moved = mask ^ (1 << piece) ^ (1 << destination)
+                    if moved in seen or bin(moved & outside_mask).count("1") > pieces:
+                        continue
+                    seen.add(moved)
+                    distances[table.rank(moved)] = min(distance, unknown - 1)
+                    following.append(moved)
+        frontier = following
+    return table
+
+"""
+Get the file name of the table for a player.
+"""
+def table_path(numPlayers, number, directory=None):
+    if directory == None:
+        directory = default_directory
+    return os.path.join(directory, "endgame" + str(numPlayers) + "-" + str(number) + ".tbl")
+
+# Tables that have been loaded (or found missing), by path
+loaded = {}
+
+"""
+Get the table for a player, loading it the first time. Returns None if
+there is no table file for them.
+"""
+def get_table(numPlayers, number, directory=None):
+    path = table_path(numPlayers, number, directory)
+    if path not in loaded:
+        if os.path.exists(path):
+            loaded[path] = load(path)
+        else:
+            loaded[path] = None
+    return loaded[path]
+
+"""
+Find the move for the current player that gets closest to finishing,
+according to the table. Returns (source index, destination index), or None
+if the table does not cover this position or has no better move.
+"""
+def best_move(board, table):
+    bits = board.bits
+    mask = bits.masks[table.number]
+    # The table was made without other pieces around, so don't trust it if
+    # an opponent is in the way
+    if bits.occupied & ~mask & table.domain:
+        return None
+    current = table.distance(mask)
+    if current == None or current == 0:
+        return None
+    best = None
+    for piece in bit_indices(mask):
+        for destination in bits.destinations(piece):
+            distance = table.distance(mask ^ (1 << piece) ^ (1 << destination))
+            if distance != None and (best == None or distance < best[0]):
+                best = (distance, piece, destination)
+    if best == None or best[0] >= current:
+        return None
+    return best[1:]
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description = "Generate endgame tables.")
+    parser.add_argument("--players", type = int, default = 2, choices = [2, 3])
+    parser.add_argument("--pieces", type = int, default = 3,
+            help = "most pieces outside the end triangle (default 3)")
+    parser.add_argument("--reach", type = int, default = 2,
+            help = "steps from the end triangle those pieces may be (default 2)")
+    parser.add_argument("--directory", default = default_directory,
+            help = "where to write the tables")
+    args = parser.parse_args()
+    for number in range(1, args.players + 1):
+        table = generate(args.players, number, args.pieces, args.reach)
+        path = table_path(args.players, number, args.directory)
+        table.save(path)
+        known = [d for d in table.distances if d != unknown]
+        print "Wrote", path + ":", len(known), "of", table.size, "positions,",\
+                "longest", max(known), "moves"
@@ -0,0 +1,203 @@
+"""
+The messages sent between client.py and server.py. Every message is a frame:
+two bytes giving the length of the rest of the frame, one byte giving the
+type of message, and then the message itself. Points are sent as their board
+index (see bitboard.tables), and a move as the whole path of the piece, from
+where it started to where it ended up.
+
+The client starts with HELLO, giving the versions of the protocol it can
+speak, whether an AI is playing for it and the seat it wants (0 for any).
+The server answers with WELCOME, giving the version to use, the client's
+seat and which seats AIs are playing, or with ERROR if it can't give it a
+game. After that, both sides just send MOVE, and PING whenever they have
+sent nothing for a while, so each can tell the other is still there.
+
+A spectator starts with WATCH instead, giving the number of the game to
+watch. The server answers with SNAPSHOT, giving the whole board as it is,
+and then sends every MOVE made in the game. If the spectator falls too far
+behind, the moves it has not been sent yet are replaced by a new SNAPSHOT.
+"""
+
+import struct
+from bitboard import get_tables
+
+# Versions of this protocol that can be spoken
+min_version = 1
+max_version = 1
+# Sent at the start of HELLO, so a stray connection is noticed straight away
+magic = "PDMD"
+
+# Types of message
+HELLO = 1
+WELCOME = 2
+MOVE = 3
+ERROR = 4
+PING = 5
+WATCH = 6
+SNAPSHOT = 7
+
+# Seconds of sending nothing before a PING is sent, and seconds of hearing
+# nothing before the other side is taken to be gone
+heartbeat_interval = 5.0
+read_timeout = 30.0
+
+# Length and type at the start of every frame
+header_format = ">HB"
+header_size = struct.calcsize(header_format)
+# Longest frame, counting its type but not the length itself
+max_frame = 0xffff
+# magic, lowest version, highest version, whether an AI plays, seat wanted
+hello_format = ">4sBBBB"
+# magic, lowest version, highest version, game number
+watch_format = ">4sBBI"
+# players, whose turn it is, moves made; followed by the contents of every
+# point, a byte each
+snapshot_format = ">BBH"
+
+class ProtocolError(Exception):
+    pass
+
+"""
+Make a frame out of a message type and its contents.
+"""
+def frame(kind, payload=""):
+    if len(payload) + 1 > max_frame:
+        raise ProtocolError("Message too long: " + str(len(payload)) + " bytes")
+    return struct.pack(header_format, len(payload) + 1, kind) + payload
+
+def hello_frame(is_ai, seat=0):
+    return frame(HELLO, struct.pack(hello_format, magic, min_version, max_version,
+            int(is_ai), seat))
+
+# Returns (lowest version, highest version, whether an AI plays, seat wanted)
+def decode_hello(payload):
+    if len(payload) != struct.calcsize(hello_format):
+        raise ProtocolError("Badly formatted hello")
+    fields = struct.unpack(hello_format, payload)
+    if fields[0] != magic:
+        raise ProtocolError("Not a diamond client")
+    return fields[1], fields[2], bool(fields[3]), fields[4]
+
+"""
+Make a WELCOME frame. ais says, for every seat in turn, whether an AI plays
+in it; its length is the number of players.
+"""
+def welcome_frame(version, seat, ais):
+    return frame(WELCOME, struct.pack(">BBB", version, seat, len(ais)) +
+            "".join([chr(int(ai)) for ai in ais]))
+
+# Returns (version, seat, whether an AI plays in each seat)
+def decode_welcome(payload):
+    if len(payload) < 3 or len(payload) != 3 + ord(payload[2]):
+        raise ProtocolError("Badly formatted welcome")
+    version, seat, players = struct.unpack(">BBB", payload[:3])
+    return version, seat, [bool(ord(c)) for c in payload[3:]]
+
+"""
+Make a MOVE frame from the indices of the points the piece passed through,
+starting where it started.
+"""
+def move_frame(path):
+    return frame(MOVE, chr(len(path)) + "".join([chr(i) for i in path]))
+
+# Returns the path of indices of a move
+def decode_move(payload):
+    if len(payload) < 3 or len(payload) != 1 + ord(payload[0]):
+        raise ProtocolError("Badly formatted move")
+    return [ord(c) for c in payload[1:]]
+
+def watch_frame(number):
+    return frame(WATCH, struct.pack(watch_format, magic, min_version, max_version, number))
+
+# Returns (lowest version, highest version, game number)
+def decode_watch(payload):
+    if len(payload) != struct.calcsize(watch_format):
+        raise ProtocolError("Badly formatted watch")
+    fields = struct.unpack(watch_format, payload)
+    if fields[0] != magic:
+        raise ProtocolError("Not a diamond client")
+    return fields[1:]
+
+"""
+Make a SNAPSHOT frame of everything a spectator needs to show a board.
+"""
+def snapshot_frame(board):
+    return frame(SNAPSHOT, struct.pack(snapshot_format, board.numPlayers,
+            board.curPlayer.number, len(board.moves)) +
+            "".join([chr(p.contents) for p in board.cells]))
+
+# Returns (players, whose turn it is, moves made, contents of every point)
+def decode_snapshot(payload):
+    start = struct.calcsize(snapshot_format)
+    if len(payload) < start:
+        raise ProtocolError("Badly formatted snapshot")
+    players, turn, moves = struct.unpack(snapshot_format, payload[:start])
+    contents = [ord(c) for c in payload[start:]]
+    # Make sure it really is a board that can be played on
+    if players not in (2, 3) or not 1 <= turn <= players or\
+            len(contents) != get_tables(players).size or max(contents) > players:
+        raise ProtocolError("Bad snapshot")
+    return players, turn, moves, contents
+
+def error_frame(reason):
+    return frame(ERROR, reason)
+
+def ping_frame():
+    return frame(PING)
+
+"""
+Pick the version to speak with someone who can speak versions low to high,
+or None if there is none that both sides can speak.
+"""
+def negotiate(low, high):
+    version = min(high, max_version)
+    if version < max(low, min_version):
+        return None
+    return version
+
+"""
+Find the path of indices a move that has just been made on a board could
+have taken: every move can be made backwards, so this is the shortest way
+back from where the piece is now, reversed.
+"""
+def move_path(board, move):
+    source = board.get_point(move[0]).index
+    destination = board.get_point(move[1]).index
+    path = board.bits.paths(destination).get(source)
+    if path == None:
+        return [source, destination]
+    path.reverse()
+    return path
+
+"""
+Splits the bytes coming from a socket into messages, however they were
+broken up on the way: bytes are kept until the rest of their frame arrives,
+and every whole frame is given back at once.
+"""
+class FrameReader:
+    def __init__(self, limit=max_frame):
+        self.buffer = ""
+        # Longest frame to wait for; anything claiming to be longer is
+        # treated as garbage rather than waited for
+        self.limit = limit
+
+    """
+    Add bytes that have been received, and return every whole message that
+    has now arrived, as (type, contents).
+    """
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        start = 0
+        while len(self.buffer) - start >= header_size:
+            length, kind = struct.unpack(header_format,
+                    self.buffer[start:start + header_size])
+            if length == 0 or length > self.limit:
+                raise ProtocolError("Bad frame length: " + str(length))
+            end = start + 2 + length
+            if end > len(self.buffer):
+                break
+            messages.append((kind, self.buffer[start + header_size:end]))
+            start = end
+        self.buffer = self.buffer[start:]
+        return messages
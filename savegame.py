@@ -0,0 +1,159 @@
+"""
+Saved games. A save is a snapshot of the board followed by a journal of the
+turns played since: the snapshot is written once, when the game is saved,
+and every turn after that only appends a couple of bytes to the end of the
+file and syncs it to disk. Saving on every move therefore costs next to
+nothing, and a game that crashes can be carried on from its last turn by
+loading it again, which plays the journal back over the snapshot.
+
+The file starts with a header giving the format version, the number of
+players, whose turn it is, the number of points and the number of moves made
+before the snapshot. Then comes the contents of every point (a byte each, in
+index order), the moves made before the snapshot, and then the journal. A
+move is the index it started from and the index it ended on; a turn that
+was passed is written as a move from and to pass_index.
+
+Older versions of the game saved to a text file instead (see load_legacy).
+"""
+
+import os
+import struct
+
+# Start of every save, and the version of its format
+magic = "PDSG"
+version = 1
+# magic, version, players, whose turn it is, points, moves before the snapshot
+header_format = "<4sBBBBI"
+header_size = struct.calcsize(header_format)
+# source index, destination index
+move_format = "<BB"
+move_size = struct.calcsize(move_format)
+# Index written for both ends of a passed turn
+pass_index = 255
+# Where games are saved, and where the old text format saved them
+default_path = "save.pdsg"
+legacy_path = "save.dat"
+
+"""
+Get the index that the piece of a move in board.moves started on and the one
+it ended on.
+"""
+def move_indices(board, move):
+    return board.get_point(move[0]).index, board.get_point(move[1]).index
+
+"""
+Saves a board and then keeps adding the turns played on it to the end of the
+save, each one synced to disk before record returns.
+"""
+class Journal:
+    def __init__(self, path, board):
+        self.path = path
+        # Moves of board.moves already in the save
+        self.count = len(board.moves)
+        # Write the snapshot to a new file and only then put it in place of
+        # the old save, so a crash part of the way through loses nothing
+        f = open(path + ".tmp", "wb")
+        f.write(struct.pack(header_format, magic, version, board.numPlayers,
+                board.curPlayer.number, len(board.cells), self.count))
+        f.write("".join([chr(p.contents) for p in board.cells]))
+        for move in board.moves:
+            f.write(struct.pack(move_format, *move_indices(board, move)))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(path + ".tmp", path)
+        self.file = open(path, "ab")
+
+    # Add every move made on the board since the last call to the save
+    def record(self, board):
+        moves = board.moves[self.count:]
+        if not moves:
+            return
+        self.file.write("".join([struct.pack(move_format, *move_indices(board, move))
+                for move in moves]))
+        self.count += len(moves)
+        self.sync()
+
+    # Add a turn that was passed without a move to the save
+    def pass_turn(self):
+        self.file.write(struct.pack(move_format, pass_index, pass_index))
+        self.sync()
+
+    # Make sure everything written has reached the disk
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+"""
+Load a save onto a board with the same number of players, playing back every
+turn in its journal. Returns the number of turns played back, or None if the
+file is not a save for this board (in which case the board is unchanged).
+"""
+def load(path, board):
+    f = open(path, "rb")
+    data = f.read()
+    f.close()
+    if len(data) < header_size:
+        return None
+    header = struct.unpack(header_format, data[:header_size])
+    if header[0] != magic or header[1] != version:
+        return None
+    numPlayers, turn, cells, count = header[2:]
+    start = header_size + cells
+    journal = start + count * move_size
+    if numPlayers != board.numPlayers or cells != len(board.cells) or\
+            not 1 <= turn <= numPlayers or len(data) < journal:
+        return None
+    contents = [ord(c) for c in data[header_size:start]]
+    if max(contents) > numPlayers:
+        return None
+    board.set_state(contents, turn)
+    board.moves = []
+    for i in range(start, journal, move_size):
+        source, destination = struct.unpack(move_format, data[i:i + move_size])
+        board.moves.append((board.cells[source].pos, board.cells[destination].pos))
+    # Play back the journal. A crash while a turn was being written can leave
+    # half of it at the end, which is left out
+    played = 0
+    for i in range(journal, len(data) - move_size + 1, move_size):
+        source, destination = struct.unpack(move_format, data[i:i + move_size])
+        if source == pass_index and destination == pass_index:
+            board.passTurn()
+        elif source >= cells or destination >= cells or\
+                board.make_move(board.cells[source], board.cells[destination]) == False:
+            break
+        played += 1
+    return played
+
+"""
+Load a game saved in the old text format: the number of the player whose
+turn it is on the first line, then "x y contents" for every point. The
+moves that led to it were not saved, and nor was the number of players, so
+only two player games can be loaded. Returns whether the file could be read.
+"""
+def load_legacy(path, board):
+    if board.numPlayers != 2:
+        return False
+    contents = [p.contents for p in board.cells]
+    f = open(path, "r")
+    try:
+        turn = int(f.readline())
+        for line in f:
+            x, y, content = [int(s) for s in line.split()]
+            contents[board.get_point((x, y)).index] = content
+    except (ValueError, KeyError):
+        return False
+    finally:
+        f.close()
+    if not 1 <= turn <= board.numPlayers or max(contents) > board.numPlayers:
+        return False
+    # Every player must still have all their pieces
+    for number in range(1, board.numPlayers + 1):
+        if contents.count(number) != len(board.pieces[number]):
+            return False
+    board.set_state(contents, turn)
+    board.moves = []
+    return True
@@ -1,91 +1,651 @@
 #!/usr/bin/env python
 
-import sys
+"""
+A server that hosts many games at once, without a screen. Clients that
+connect (see client.py) are paired up to play each other, in the order they
+arrive: a client may ask for seat 1 or 2 in its hello, or take whichever is
+free, and waits until someone takes the other seat. If the server is given
+an AI, every client instead gets a game of its own, playing as player 2
+against the server's AI as player 1. One select loop looks after every
+socket, and the AI's moves are worked out in a pool of processes, so a long
+search in one game never holds up the others.
+
+Any number of spectators may also watch each game (see protocol.py). Every
+move is sent to them after it has been sent to the players, and each has its
+own bounded queue of messages: a spectator that can't keep up has what it
+hasn't been sent replaced by a snapshot of the board, rather than holding up
+the game or using up the server's memory.
+
+Examples: ./server.py 5000
+          ./server.py 5000 3 --processes 4
+"""
+
+import os
+import errno
+import select
+from time import time
 from socket import *
-from diamond import board, Network, screen
-
-def start_server(s, port, ai):
-    # Create the socket on localhost
-    host = "localhost"
-    s.bind((host, port))
-    # Only accept one connection at a time (no queuing)
-    s.listen(1)
-    # Every time a connection comes in
-    while True:
-        # Accept the connection
-        client, addr = s.accept()
-        # And handle the client
-        handle_client(client, addr, ai)
-
-def handle_client(client, addr, ai):
-    # Message length is 5
-    msg_len = 5
-    # Have a greeting to send to the client
-    greeting = "hello"
-    print "Connected to", addr
-    # Receive a greeting from the client
-    data = client.recv(msg_len)
-    # If the client did not greet correctly
-    if not data == greeting:
-        client.close()
-        print "Disconnected from", addr
-        return
-    # Otherwise send the client the greeting
-    client.sendall(greeting)
-    # Then tell the client whether human or AI is playing
-    if ai == -1:
-        client.sendall("human")
-    else:
-        client.sendall("is_ai")
-    # And receive the same information from the client
-    data = client.recv(msg_len)
-    b = None
-    # Build the board with the information received
-    if data == "human":
-        if ai == -1:
-            b = board(2, [False, False], [0, 0])
+from argparse import ArgumentParser
+from collections import OrderedDict, deque
+from multiprocessing import Pool, cpu_count
+from Queue import Queue, Empty
+from diamond import board
+import protocol
+from protocol import ProtocolError
+
+# Player numbers of the server's AI and of the client
+server_seat = 1
+client_seat = 2
+# Longest message a client ever needs to send
+max_client_frame = 256
+# Bytes that may wait to be sent to a spectator before it is sent a snapshot
+# instead, and snapshots it may be sent in a row without taking any of them
+# before it is dropped
+spectator_buffer = 4096
+max_resyncs = 8
+
+# Boards each worker process keeps between moves, by game number, so that
+# the AI keeps its transposition table and old moves need not be played again
+worker_boards = OrderedDict()
+# Most games a worker keeps a board for
+worker_boards_size = 64
+
+"""
+Work out the server AI's move in a game, given as (game number, difficulty,
+max search time, moves so far). Runs in a worker process. Returns (game
+number, move, error), where the move is None if the AI made none and error
+describes anything that went wrong.
+"""
+def compute_move(job):
+    number, difficulty, max_time, moves = job
+    try:
+        b = worker_boards.pop(number, None)
+        # Start again unless the kept board got to this position
+        if b == None or b.moves != moves[:len(b.moves)]:
+            b = board(2, [True, False], [difficulty, 0])
+        for source, destination in moves[len(b.moves):]:
+            b.make_move(source, destination)
+        ai = b.players[server_seat - 1].AI
+        ai.max_time = max_time
+        made = len(b.moves)
+        ai.ai_player(b)
+        # Keep the board, forgetting the game that has waited longest
+        worker_boards[number] = b
+        if len(worker_boards) > worker_boards_size:
+            worker_boards.popitem(last = False)
+        if len(b.moves) > made:
+            return number, b.moves[made], None
+        return number, None, None
+    except Exception as e:
+        return number, None, repr(e)
+
+class Client:
+    def __init__(self, connection, address):
+        self.socket = connection
+        self.address = address
+        # What the client is doing: "hello" until it says hello, "waiting"
+        # for an opponent, then "playing"
+        self.state = "hello"
+        # Game the client plays in, their seat in it, whether an AI plays for
+        # them and the version of the protocol agreed with them
+        self.game = None
+        self.seat = None
+        self.is_ai = False
+        self.version = None
+        # Splits what is received into messages, and bytes waiting to be sent
+        self.reader = protocol.FrameReader(max_client_frame)
+        self.outbox = ""
+        # Whether to hang up once everything has been sent
+        self.closing = False
+        # When something was last received from and sent to the client
+        self.last_received = time()
+        self.last_sent = time()
+
+class Game:
+    def __init__(self):
+        # Given when the game starts
+        self.number = None
+        self.board = None
+        # Clients playing, by seat. A seat with no client is the server's AI
+        # once the game has started
+        self.seats = {}
+        # Whether the game is over (or was given up), so nothing more is
+        # played in it
+        self.closing = False
+        # Spectators watching the game
+        self.spectators = []
+
+class Spectator:
+    def __init__(self, connection, address, game, reader):
+        self.socket = connection
+        self.address = address
+        # Game being watched
+        self.game = game
+        self.reader = reader
+        # Frames waiting to be sent, how many bytes they come to, and how
+        # much of the first one has been sent already
+        self.frames = deque()
+        self.queued = 0
+        self.offset = 0
+        # Whether to hang up once everything has been sent
+        self.closing = False
+        # Snapshots sent in place of moves since the spectator last took
+        # anything
+        self.resyncs = 0
+        # When something was last received from and sent to the spectator
+        self.last_received = time()
+        self.last_sent = time()
+
+class GameServer:
+    def __init__(self, port, difficulty=None, max_time=1.0, processes=None, host="localhost",
+            read_timeout=protocol.read_timeout, heartbeat_interval=protocol.heartbeat_interval,
+            spectator_buffer=spectator_buffer):
+        # The AI player the server puts in every game, or None to pair
+        # clients to play each other
+        self.difficulty = difficulty
+        self.max_time = max_time
+        # Seconds of silence before a client is taken to be gone, and before
+        # a PING is sent to show the server is still here
+        self.read_timeout = read_timeout
+        self.heartbeat_interval = heartbeat_interval
+        # Bytes that may wait to be sent to each spectator
+        self.spectator_buffer = spectator_buffer
+        # Start the workers before any sockets are open, so they don't
+        # inherit them
+        self.pool = Pool(processes or cpu_count())
+        # Moves that workers have finished, and a pipe that is written to
+        # whenever one is, to wake up select
+        self.results = Queue()
+        self.wake_read, self.wake_write = os.pipe()
+        self.listener = socket()
+        self.listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(128)
+        self.listener.setblocking(0)
+        # Port actually listened on (useful when port 0 is asked for)
+        self.port = self.listener.getsockname()[1]
+        # Clients playing (or waiting to), by socket
+        self.clients = {}
+        # Games that have started, by number, and games waiting for a second
+        # client, oldest first
+        self.numbers = {}
+        self.next_number = 0
+        self.waiting = []
+        # Spectators of every game, by socket
+        self.spectators = {}
+        self.running = True
+
+    """
+    Wait for something to happen, for at most timeout seconds if given, and
+    deal with it: new connections, data from clients, room to send data to
+    them, and moves from the workers.
+    """
+    def poll(self, timeout=None):
+        readers = [self.listener, self.wake_read] + self.clients.keys() + self.spectators.keys()
+        writers = [s for s in self.clients if self.clients[s].outbox] +\
+                [s for s in self.spectators if self.spectators[s].frames]
+        # Wake up in time to send heartbeats
+        if timeout == None or timeout > self.heartbeat_interval:
+            timeout = self.heartbeat_interval
+        try:
+            readable, writable, broken = select.select(readers, writers, [], timeout)
+        except select.error as e:
+            # A signal arrived; just go round again
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for s in readable:
+            if s is self.listener:
+                self.accept()
+            elif s == self.wake_read:
+                self.handle_results()
+            elif s in self.clients:
+                self.receive(self.clients[s])
+            elif s in self.spectators:
+                self.receive_spectator(self.spectators[s])
+        # Players first, so spectators never hold up the game
+        for s in writable:
+            if s in self.clients:
+                self.send(self.clients[s])
+        for s in writable:
+            if s in self.spectators:
+                self.send_spectator(self.spectators[s])
+        self.check_timeouts()
+
+    # Hang up on clients that have been silent for too long, and let the
+    # others know the server is still here if it has been. Clients waiting
+    # for an opponent have nothing to say, so only get pings
+    def check_timeouts(self):
+        now = time()
+        for client in self.clients.values():
+            if client.state != "waiting" and now - client.last_received > self.read_timeout:
+                print "Timed out", client.address
+                self.drop(client)
+            elif not client.outbox and now - client.last_sent >= self.heartbeat_interval:
+                client.outbox += protocol.ping_frame()
+        for spectator in self.spectators.values():
+            if now - spectator.last_received > self.read_timeout:
+                print "Timed out", spectator.address
+                self.drop_spectator(spectator)
+            elif not spectator.frames and now - spectator.last_sent >= self.heartbeat_interval:
+                self.queue_frame(spectator, protocol.ping_frame())
+
+    # Keep polling until stopped
+    def serve_forever(self):
+        while self.running:
+            self.poll()
+
+    # Stop the workers and hang up on everyone
+    def close(self):
+        self.running = False
+        self.pool.terminate()
+        self.pool.join()
+        for client in self.clients.values():
+            client.socket.close()
+        for spectator in self.spectators.values():
+            spectator.socket.close()
+        self.clients = {}
+        self.numbers = {}
+        self.waiting = []
+        self.spectators = {}
+        self.listener.close()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+    # Take a new connection, which will either play a game or watch one
+    def accept(self):
+        try:
+            connection, address = self.listener.accept()
+        except error as e:
+            # Someone else took it, or it went away already
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                return
+            raise
+        connection.setblocking(0)
+        self.clients[connection] = Client(connection, address)
+        print "Connected to", address
+
+    # Hang up on a client straight away, ending the game they were in
+    def drop(self, client):
+        client.socket.close()
+        del self.clients[client.socket]
+        if client.game != None:
+            self.end_game(client.game, "Opponent left")
+        print "Disconnected from", client.address
+
+    # Read whatever a client has sent
+    def receive(self, client):
+        try:
+            data = client.socket.recv(4096)
+        except error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ""
+        # The client went away
+        if not data:
+            self.drop(client)
+            return
+        client.last_received = time()
+        # Nothing more is listened to once the game is over
+        if client.closing:
+            return
+        try:
+            messages = client.reader.feed(data)
+        except ProtocolError:
+            self.drop(client)
+            return
+        for message in messages:
+            if client.socket not in self.clients or client.closing:
+                return
+            self.handle_message(client, message)
+
+    # Send as much of what is waiting for a client as it will take
+    def send(self, client):
+        try:
+            sent = client.socket.send(client.outbox)
+        except error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.drop(client)
+            return
+        client.outbox = client.outbox[sent:]
+        client.last_sent = time()
+        if not client.outbox and client.closing:
+            self.drop(client)
+
+    # Hang up on a client, telling them why, and end the game they were in
+    def refuse(self, client, reason):
+        print "Stopped game with", client.address, reason
+        client.outbox += protocol.error_frame(reason)
+        self.finish(client)
+        if client.game != None:
+            self.end_game(client.game, "Opponent left")
+
+    # Hang up on a client once everything waiting for it has been sent
+    def finish(self, client):
+        client.closing = True
+        if not client.outbox:
+            self.drop(client)
+
+    """
+    End a game: hang up on its clients once they have been sent everything
+    waiting for them (telling them the reason first, if given) and on its
+    spectators likewise.
+    """
+    def end_game(self, game, reason=None):
+        if game.closing:
+            return
+        game.closing = True
+        if game.number != None:
+            del self.numbers[game.number]
+        if game in self.waiting:
+            self.waiting.remove(game)
+        for client in game.seats.values():
+            if client.socket in self.clients and not client.closing:
+                if reason != None:
+                    client.outbox += protocol.error_frame(reason)
+                self.finish(client)
+        for spectator in list(game.spectators):
+            self.finish_spectator(spectator)
+
+    # Deal with a message from a client
+    def handle_message(self, client, message):
+        kind, payload = message
+        if client.state == "hello":
+            if kind == protocol.WATCH:
+                self.watch(client, payload)
+            elif kind == protocol.HELLO:
+                self.hello(client, payload)
+            else:
+                self.drop(client)
+        elif kind == protocol.PING:
+            # Only there to show the client is still connected
+            pass
+        elif kind == protocol.MOVE and client.state == "playing":
+            try:
+                path = protocol.decode_move(payload)
+            except ProtocolError:
+                self.drop(client)
+                return
+            self.client_move(client, path)
         else:
-            b = board(2, [True, False], [ai, 0])
-    elif data == "is_ai":
-        if ai == -1:
-            b = board(2, [False, True], [0, 0])
+            self.drop(client)
+
+    """
+    Give a client that has said hello a seat. With a server AI, the client
+    plays against it straight away. Otherwise they join the oldest game
+    waiting for a client in the seat they asked for (0 for any), or start a
+    new game and wait for someone to join it.
+    """
+    def hello(self, client, payload):
+        try:
+            low, high, is_ai, seat = protocol.decode_hello(payload)
+        except ProtocolError:
+            self.drop(client)
+            return
+        client.version = protocol.negotiate(low, high)
+        client.is_ai = is_ai
+        if client.version == None:
+            self.refuse(client, "No protocol version in common")
+            return
+        if seat > 2 or (self.difficulty != None and seat == server_seat):
+            self.refuse(client, "Seat " + str(seat) + " is not free")
+            return
+        if self.difficulty != None:
+            game = Game()
+            self.take_seat(game, client, client_seat)
+            self.start_game(game)
+            return
+        for game in self.waiting:
+            free = 3 - game.seats.keys()[0]
+            if seat == 0 or seat == free:
+                self.waiting.remove(game)
+                self.take_seat(game, client, free)
+                self.start_game(game)
+                return
+        game = Game()
+        self.take_seat(game, client, seat or 1)
+        client.state = "waiting"
+        self.waiting.append(game)
+        print client.address, "is waiting for an opponent"
+
+    # Sit a client in one of a game's seats
+    def take_seat(self, game, client, seat):
+        game.seats[seat] = client
+        client.game = game
+        client.seat = seat
+
+    # Start a game whose seats are all taken, welcoming its clients
+    def start_game(self, game):
+        ais = [self.difficulty != None, False]
+        for seat, client in game.seats.items():
+            ais[seat - 1] = client.is_ai
+        game.board = board(2, [False, False], [0, 0])
+        game.number = self.next_number
+        self.next_number += 1
+        self.numbers[game.number] = game
+        for seat, client in game.seats.items():
+            client.outbox += protocol.welcome_frame(client.version, seat, ais)
+            client.state = "playing"
+            # A client that waited for an opponent had nothing to say
+            client.last_received = time()
+        print "Started game", game.number, "with",\
+                ", ".join([str(c.address) for c in game.seats.values()])
+        self.next_turn(game)
+
+    # Ask the server's AI for a move if it is its turn
+    def next_turn(self, game):
+        if game.board.curPlayer.number not in game.seats:
+            self.start_move(game)
+
+    # Play a move that a client sent, if it may make it. Only the ends of the
+    # path matter: the piece may go anywhere it could get to
+    def client_move(self, client, path):
+        game = client.game
+        b = game.board
+        source = None
+        destination = None
+        if path[0] < len(b.cells) and path[-1] < len(b.cells):
+            source = b.cells[path[0]]
+            destination = b.cells[path[-1]]
+        # Clients may only move their own pieces, on their own turn, to
+        # somewhere the piece can reach
+        if b.curPlayer.number != client.seat or source == None or\
+                source.contents != client.seat or\
+                destination.index not in b.bits.destinations(source.index):
+            self.refuse(client, "Bad move")
+            return
+        b.make_move(source, destination)
+        # Ask for the AI's reply before anything is sent to the spectators
+        if not b.winners():
+            self.next_turn(game)
+        self.played(game, b.moves[-1], client)
+
+    """
+    Send a move that has just been played in a game to everyone but the
+    client who made it (None for the server's AI), and end the game if it
+    has been won.
+    """
+    def played(self, game, move, mover):
+        frame = protocol.move_frame(protocol.move_path(game.board, move))
+        for client in game.seats.values():
+            if client is not mover:
+                client.outbox += frame
+        self.broadcast(game, frame)
+        if game.board.winners():
+            self.end_game(game)
+
+    # Ask a worker for the server AI's move in a game
+    def start_move(self, game):
+        job = (game.number, self.difficulty, self.max_time, list(game.board.moves))
+        self.pool.apply_async(compute_move, [job], callback = self.finished_move)
+
+    # Called in the pool's own thread when a worker finishes a move
+    def finished_move(self, result):
+        self.results.put(result)
+        os.write(self.wake_write, "m")
+
+    # Play the moves the workers have finished and send them to the clients
+    def handle_results(self):
+        os.read(self.wake_read, 4096)
+        while True:
+            try:
+                number, move, problem = self.results.get_nowait()
+            except Empty:
+                return
+            game = self.numbers.get(number)
+            # The game may have ended while the AI was thinking
+            if game == None or game.closing:
+                continue
+            if move == None:
+                print "AI made no move in game", number, problem or ""
+                self.end_game(game, "Server AI failed")
+                continue
+            game.board.make_move(move[0], move[1])
+            if not game.board.winners():
+                self.next_turn(game)
+            self.played(game, move, None)
+
+    # Turn a connection that has not said hello into a spectator of the game
+    # it asks to watch, and send it the board as it is now
+    def watch(self, client, payload):
+        try:
+            low, high, number = protocol.decode_watch(payload)
+        except ProtocolError:
+            self.drop(client)
+            return
+        watched = self.numbers.get(number)
+        if protocol.negotiate(low, high) == None:
+            self.refuse(client, "No protocol version in common")
+        elif watched == None or watched.closing:
+            self.refuse(client, "No game " + str(number))
         else:
-            b = board(2, [True, True], [ai, 0])
-    else:
-        client.close()
-        print "Disconnected from", addr
-        return
-    # Create the network object for the game
-    net = Network(client, 1) # player 1
-    # Then create a new diamond game
-    game = screen(b, 450, 1000, net)
-    game.mainloop()
-    # Close the client socket when finished
-    client.close()
-    print "Disconnected from", addr
+            del self.clients[client.socket]
+            spectator = Spectator(client.socket, client.address, watched, client.reader)
+            self.spectators[spectator.socket] = spectator
+            watched.spectators.append(spectator)
+            self.queue_frame(spectator, protocol.snapshot_frame(watched.board))
+            print client.address, "is watching game", number
+
+    # Send a frame to everyone watching a game. The frame is only queued
+    # here; it is sent once the players have been sent what they are waiting
+    # for (see poll)
+    def broadcast(self, game, frame):
+        # Slow spectators may be dropped along the way
+        for spectator in list(game.spectators):
+            self.queue_frame(spectator, frame)
+
+    # Queue a frame for a spectator, sending it a snapshot instead of
+    # everything still waiting if there is no room for the frame
+    def queue_frame(self, spectator, frame):
+        if spectator.closing:
+            return
+        if spectator.queued + len(frame) > self.spectator_buffer:
+            self.resync(spectator)
+            return
+        spectator.frames.append(frame)
+        spectator.queued += len(frame)
+
+    # Throw away what a spectator has not been sent and send it the board as
+    # it is now instead, keeping any frame that has been partly sent so the
+    # stream stays whole. Drops spectators that never catch up
+    def resync(self, spectator):
+        spectator.resyncs += 1
+        if spectator.resyncs > max_resyncs:
+            print "Too slow:", spectator.address
+            self.drop_spectator(spectator)
+            return
+        kept = deque()
+        if spectator.offset:
+            kept.append(spectator.frames[0])
+        spectator.frames = kept
+        spectator.queued = sum([len(frame) for frame in kept])
+        snapshot = protocol.snapshot_frame(spectator.game.board)
+        spectator.frames.append(snapshot)
+        spectator.queued += len(snapshot)
+
+    # Read whatever a spectator has sent, which should only be pings
+    def receive_spectator(self, spectator):
+        try:
+            data = spectator.socket.recv(4096)
+        except error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ""
+        if not data:
+            self.drop_spectator(spectator)
+            return
+        spectator.last_received = time()
+        try:
+            messages = spectator.reader.feed(data)
+        except ProtocolError:
+            self.drop_spectator(spectator)
+            return
+        for kind, payload in messages:
+            if kind != protocol.PING:
+                self.drop_spectator(spectator)
+                return
+
+    # Send as much of what is waiting for a spectator as it will take
+    def send_spectator(self, spectator):
+        data = "".join(spectator.frames)[spectator.offset:]
+        try:
+            sent = spectator.socket.send(data)
+        except error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.drop_spectator(spectator)
+            return
+        spectator.last_sent = time()
+        spectator.resyncs = 0
+        # Forget the frames that have been sent completely
+        sent += spectator.offset
+        while spectator.frames and sent >= len(spectator.frames[0]):
+            frame = spectator.frames.popleft()
+            sent -= len(frame)
+            spectator.queued -= len(frame)
+        spectator.offset = sent
+        if not spectator.frames and spectator.closing:
+            self.drop_spectator(spectator)
+
+    # Hang up on a spectator once everything waiting for it has been sent
+    def finish_spectator(self, spectator):
+        spectator.closing = True
+        if not spectator.frames:
+            self.drop_spectator(spectator)
+
+    # Hang up on a spectator straight away
+    def drop_spectator(self, spectator):
+        spectator.socket.close()
+        del self.spectators[spectator.socket]
+        spectator.game.spectators.remove(spectator)
+        print "Spectator", spectator.address, "left"
 
 if __name__ == '__main__':
-    # Get and check arguments
-    argc, argv = len(sys.argv), sys.argv
-    if argc != 2 and argc != 3:
-        print "Usage: ./server.py <port> [<AI>]"
-        sys.exit(1)
-    # Create the socket
-    s = socket()
+    parser = ArgumentParser(description = "Host games for clients.")
+    parser.add_argument("port", type = int)
+    parser.add_argument("ai", type = int, nargs = "?", default = None,
+            choices = range(5), help = "difficulty of an AI for every client to play "
+            "against (without it, clients are paired to play each other)")
+    parser.add_argument("--host", default = "localhost")
+    parser.add_argument("--max-time", type = float, default = 1.0,
+            help = "seconds the AI may think per move")
+    parser.add_argument("--processes", type = int, default = cpu_count(),
+            help = "processes working out AI moves")
+    parser.add_argument("--read-timeout", type = float, default = protocol.read_timeout,
+            help = "seconds of silence before a client is dropped")
+    parser.add_argument("--heartbeat", type = float, default = protocol.heartbeat_interval,
+            help = "seconds of sending nothing before a ping is sent")
+    parser.add_argument("--spectator-buffer", type = int, default = spectator_buffer,
+            help = "bytes that may wait to be sent to a spectator")
+    args = parser.parse_args()
+    server = GameServer(args.port, args.ai, args.max_time, args.processes, args.host,
+            args.read_timeout, args.heartbeat, args.spectator_buffer)
     try:
-        # Handles optional AI argument
-        ai = -1
-        if argc == 3:
-            ai = int(argv[2])
-        # Start the server
-        start_server(s, int(argv[1]), ai)
+        server.serve_forever()
     # If user Ctrl-C-ed out, exit cleanly
     except KeyboardInterrupt:
         print "Bye"
-    # If port number could not be parsed, notify user
-    except ValueError:
-        print "Argument", argv[1], "or", argv[2], "not an integer."
-        sys.exit(1)
-    # Make sure to close the socket
+    # Make sure to close the sockets
     finally:
-        s.close()
+        server.close()
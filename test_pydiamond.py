@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+"""
+Tests for the board, the network protocol, saved games and the server.
+
+Run with: python -m unittest test_pydiamond
+"""
+
+import os
+import struct
+import shutil
+import socket
+import tempfile
+import unittest
+from threading import Thread
+from time import time, sleep
+
+# The board module loads pygame; make sure it never needs a real screen
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import protocol
+import savegame
+import server
+from protocol import ProtocolError
+from bitboard import zobrist_hash
+from diamond import board, Network
+
+# Get the first move the player whose turn it is can make, as (source,
+# destination) points
+def first_move(b):
+    for source in b.pieces[b.curPlayer.number]:
+        for index in b.bits.destinations(source.index):
+            return source, b.cells[index]
+
+class BoardTest(unittest.TestCase):
+    def test_unmake_move_restores_hash(self):
+        b = board(2, [False, False], [0, 0])
+        before = (b.hash, b.curPlayer, [p.contents for p in b.cells])
+        undos = []
+        for i in range(6):
+            undos.append(b.make_move(*first_move(b)))
+            # The hash kept up as moves are made is the one worked out afresh
+            self.assertEqual(b.hash, zobrist_hash(b.bits, b.curPlayer.number))
+        for undo in reversed(undos):
+            b.unmake_move(undo)
+        self.assertEqual((b.hash, b.curPlayer, [p.contents for p in b.cells]), before)
+        self.assertEqual(b.moves, [])
+
+class FrameReaderTest(unittest.TestCase):
+    def test_partial_frame(self):
+        reader = protocol.FrameReader()
+        data = protocol.move_frame([1, 2, 3])
+        # Nothing comes out until the whole frame has arrived
+        for c in data[:-1]:
+            self.assertEqual(reader.feed(c), [])
+        self.assertEqual(reader.feed(data[-1]), [(protocol.MOVE, "\x03\x01\x02\x03")])
+
+    def test_several_frames(self):
+        reader = protocol.FrameReader()
+        data = protocol.move_frame([4, 5]) + protocol.ping_frame() + protocol.error_frame("x")
+        # Half of the last frame waits for the rest
+        self.assertEqual(reader.feed(data[:-1]),
+                [(protocol.MOVE, "\x02\x04\x05"), (protocol.PING, "")])
+        self.assertEqual(reader.feed(data[-1]), [(protocol.ERROR, "x")])
+
+    def test_bad_length(self):
+        self.assertRaises(ProtocolError, protocol.FrameReader().feed, "\x00\x00\x03")
+        self.assertRaises(ProtocolError, protocol.FrameReader(8).feed, "\x00\x09\x03")
+
+class DecodeTest(unittest.TestCase):
+    def payload(self, data):
+        return protocol.FrameReader().feed(data)[0][1]
+
+    def test_hello(self):
+        hello = self.payload(protocol.hello_frame(True, 2))
+        self.assertEqual(protocol.decode_hello(hello),
+                (protocol.min_version, protocol.max_version, True, 2))
+        self.assertRaises(ProtocolError, protocol.decode_hello, hello[:-1])
+        self.assertRaises(ProtocolError, protocol.decode_hello, "XXXX" + hello[4:])
+
+    def test_welcome(self):
+        welcome = self.payload(protocol.welcome_frame(1, 2, [True, False]))
+        self.assertEqual(protocol.decode_welcome(welcome), (1, 2, [True, False]))
+        self.assertRaises(ProtocolError, protocol.decode_welcome, welcome[:-1])
+        self.assertRaises(ProtocolError, protocol.decode_welcome, "")
+
+    def test_move(self):
+        self.assertEqual(protocol.decode_move("\x02\x01\x02"), [1, 2])
+        # Too short to be a move, and a length that doesn't match the path
+        self.assertRaises(ProtocolError, protocol.decode_move, "\x01\x01")
+        self.assertRaises(ProtocolError, protocol.decode_move, "\x03\x01\x02")
+
+    def test_watch(self):
+        watch = self.payload(protocol.watch_frame(7))
+        self.assertEqual(protocol.decode_watch(watch)[2], 7)
+        self.assertRaises(ProtocolError, protocol.decode_watch, watch[:-1])
+        self.assertRaises(ProtocolError, protocol.decode_watch, "XXXX" + watch[4:])
+
+    def test_snapshot(self):
+        b = board(2, [False, False], [0, 0])
+        snapshot = self.payload(protocol.snapshot_frame(b))
+        players, turn, moves, contents = protocol.decode_snapshot(snapshot)
+        self.assertEqual((players, turn, moves), (2, 1, 0))
+        self.assertEqual(contents, [p.contents for p in b.cells])
+        header = struct.pack(protocol.snapshot_format, 2, 1, 0)
+        cells = snapshot[len(header):]
+        bad = [header + cells[:-1],
+                struct.pack(protocol.snapshot_format, 4, 1, 0) + cells,
+                struct.pack(protocol.snapshot_format, 2, 3, 0) + cells,
+                struct.pack(protocol.snapshot_format, 2, 0, 0) + cells,
+                header + "\x03" + cells[1:]]
+        for payload in bad:
+            self.assertRaises(ProtocolError, protocol.decode_snapshot, payload)
+
+class SaveGameTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "save.pdsg")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_journal(self):
+        b = board(2, [False, False], [0, 0])
+        b.make_move(*first_move(b))
+        journal = savegame.Journal(self.path, b)
+        for i in range(3):
+            b.make_move(*first_move(b))
+            journal.record(b)
+        journal.pass_turn()
+        b.passTurn()
+        journal.close()
+        loaded = board(2, [False, False], [0, 0])
+        self.assertEqual(savegame.load(self.path, loaded), 4)
+        self.assertEqual([p.contents for p in loaded.cells], [p.contents for p in b.cells])
+        self.assertEqual((loaded.moves, loaded.curPlayer.number, loaded.hash),
+                (b.moves, b.curPlayer.number, b.hash))
+
+    def test_half_written_record(self):
+        b = board(2, [False, False], [0, 0])
+        journal = savegame.Journal(self.path, b)
+        b.make_move(*first_move(b))
+        journal.record(b)
+        journal.close()
+        expected = [p.contents for p in b.cells]
+        # A crash part of the way through writing the next move
+        f = open(self.path, "ab")
+        f.write(chr(first_move(b)[0].index))
+        f.close()
+        loaded = board(2, [False, False], [0, 0])
+        self.assertEqual(savegame.load(self.path, loaded), 1)
+        self.assertEqual([p.contents for p in loaded.cells], expected)
+        self.assertEqual(loaded.curPlayer.number, b.curPlayer.number)
+
+    def test_wrong_board(self):
+        savegame.Journal(self.path, board(2, [False, False], [0, 0])).close()
+        b = board(3, [False] * 3, [0] * 3)
+        self.assertEqual(savegame.load(self.path, b), None)
+
+class ServerTest(unittest.TestCase):
+    def start(self, difficulty):
+        self.server = server.GameServer(0, difficulty, 0.05, 1,
+                read_timeout=5.0, heartbeat_interval=0.2)
+        self.running = True
+        def serve():
+            while self.running:
+                self.server.poll(0.05)
+        self.thread = Thread(target=serve)
+        self.thread.start()
+
+    def tearDown(self):
+        self.running = False
+        self.thread.join()
+        self.server.close()
+
+    def connect(self):
+        return Network(socket.create_connection(("localhost", self.server.port)), 0)
+
+    # Wait for a move to arrive over a connection
+    def receive_move(self, net):
+        deadline = time() + 10
+        while not net.moves and net.socket != None and time() < deadline:
+            net.poll(0.05)
+        self.assertTrue(net.moves)
+        return net.moves.popleft()
+
+    def test_paired_game(self):
+        self.start(None)
+        # Nobody else is here yet, so the first client waits
+        first = self.connect()
+        welcomes = []
+        waiting = Thread(target=lambda: welcomes.append(first.handshake(False, 2)))
+        waiting.start()
+        sleep(0.5)
+        self.assertEqual(welcomes, [])
+        second = self.connect()
+        self.assertEqual(second.handshake(False), (protocol.max_version, 1, [False, False]))
+        waiting.join()
+        self.assertEqual(welcomes, [(protocol.max_version, 2, [False, False])])
+        watcher = self.connect()
+        players, turn, moves, contents = watcher.watch(0)
+        self.assertEqual((players, turn, moves), (2, 1, 0))
+        # A move by one player reaches the other and the spectator
+        b = board(2, [False, False], [0, 0])
+        source, destination = first_move(b)
+        second.send(protocol.move_frame([source.index, destination.index]))
+        self.assertEqual(self.receive_move(first), [source.index, destination.index])
+        self.assertEqual(self.receive_move(watcher), [source.index, destination.index])
+        # Playing out of turn is refused, and the opponent is told
+        second.send(protocol.move_frame([source.index, destination.index]))
+        deadline = time() + 10
+        while (first.socket != None or second.socket != None) and time() < deadline:
+            for net in (first, second):
+                if net.socket != None:
+                    net.poll(0.05)
+        self.assertEqual((first.socket, second.socket), (None, None))
+
+    def test_server_ai(self):
+        self.start(0)
+        refused = self.connect()
+        self.assertRaises(ProtocolError, refused.handshake, False, server.server_seat)
+        net = self.connect()
+        self.assertEqual(net.handshake(False),
+                (protocol.max_version, server.client_seat, [True, False]))
+        # The server's AI moves first
+        path = self.receive_move(net)
+        self.assertEqual(self.server.numbers[0].board.moves[0][1],
+                self.server.numbers[0].board.cells[path[-1]].pos)
+
+if __name__ == '__main__':
+    unittest.main()
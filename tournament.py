@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""
+Play many games between the AI difficulty levels without a screen, spread
+over every core, and report how well each level does against the others.
+
+Example: ./tournament.py --games 100 --tiers 0123 --json results.json
+"""
+
+import sys
+import csv
+import json
+import random
+from argparse import ArgumentParser
+from itertools import permutations
+from multiprocessing import Pool, cpu_count
+from time import time
+from diamond import board, run_game
+
+# Names of the AI difficulty levels, in the order of AI.ai_list
+tier_names = ["random_ai", "directional_slide_ai", "naive_maximizer_ai",
+        "best_score", "alpha_beta_ai"]
+
+"""
+Play one game, given as (game number, tier of each seat, seed, max moves,
+max search time). Runs in a worker process, so everything it needs comes in
+the job and everything it finds goes back in the returned dictionary.
+"""
+def play_game(job):
+    number, tiers, seed, max_moves, max_time = job
+    random.seed(seed)
+    numPlayers = len(tiers)
+    b = board(numPlayers, [True] * numPlayers, list(tiers))
+    for p in b.players:
+        p.AI.max_time = max_time
+    # Total thinking time and turns taken by each seat
+    think = [0.0] * numPlayers
+    turns = [0] * numPlayers
+    def on_move(b, player, seconds):
+        think[player.number - 1] += seconds
+        turns[player.number - 1] += 1
+    result = {"game": number, "tiers": list(tiers), "seed": seed,
+            "winners": [], "moves": 0, "error": None}
+    start = time()
+    try:
+        result["winners"] = run_game(b, max_moves, on_move)
+    # A broken AI loses the game rather than stopping the tournament
+    except Exception as e:
+        result["error"] = "player " + str(b.curPlayer.number) + ": " + repr(e)
+    result["moves"] = len(b.moves)
+    result["seconds"] = time() - start
+    result["think"] = think
+    result["turns"] = turns
+    return result
+
+"""
+Make the list of games to play: every seating of every pairing (or triple)
+of tiers, games_each times, each with its own seed.
+"""
+def make_jobs(tiers, numPlayers, games_each, seed, max_moves, max_time):
+    jobs = []
+    for seating in permutations(tiers, numPlayers):
+        for i in range(games_each):
+            jobs.append((len(jobs), seating, seed + len(jobs), max_moves, max_time))
+    return jobs
+
+"""
+Add up game results into per-tier statistics and a crosstable, where
+crosstable[a][b] counts games in which tier a sat against tier b, and how
+many of those tier a won.
+"""
+def summarise(results):
+    tiers = {}
+    crosstable = {}
+    for result in results:
+        seats = result["tiers"]
+        for seat in range(len(seats)):
+            tier = tier_names[seats[seat]]
+            stats = tiers.setdefault(tier, {"games": 0, "wins": 0,
+                "unfinished": 0, "errors": 0, "moves": 0, "think": 0.0,
+                "turns": 0})
+            won = seat + 1 in result["winners"]
+            stats["games"] += 1
+            stats["wins"] += won
+            stats["unfinished"] += not result["winners"]
+            stats["errors"] += result["error"] != None
+            stats["moves"] += result["moves"]
+            stats["think"] += result["think"][seat]
+            stats["turns"] += result["turns"][seat]
+            for other in range(len(seats)):
+                if other == seat:
+                    continue
+                row = crosstable.setdefault(tier, {})
+                cell = row.setdefault(tier_names[seats[other]], {"games": 0, "wins": 0})
+                cell["games"] += 1
+                cell["wins"] += won
+    for stats in tiers.values():
+        stats["win_rate"] = float(stats["wins"]) / stats["games"]
+        stats["average_moves"] = float(stats["moves"]) / stats["games"]
+        stats["think_per_move"] = stats["think"] / max(stats["turns"], 1)
+    return {"tiers": tiers, "crosstable": crosstable}
+
+"""
+Print the per-tier statistics and the crosstable of win rates.
+"""
+def print_summary(summary):
+    tiers = sorted(summary["tiers"], key = tier_names.index)
+    width = max(len(name) for name in tiers) + 2
+    print "".ljust(width) + "games   win%   moves   ms/move   errors"
+    for name in tiers:
+        stats = summary["tiers"][name]
+        print name.ljust(width) + "%5d  %5.1f  %6.1f  %8.2f   %6d" % (stats["games"],
+                100 * stats["win_rate"], stats["average_moves"],
+                1000 * stats["think_per_move"], stats["errors"])
+    print
+    print "Win % of row against column:"
+    print "".ljust(width) + "".join(name[:10].rjust(12) for name in tiers)
+    for row in tiers:
+        line = row.ljust(width)
+        for column in tiers:
+            cell = summary["crosstable"].get(row, {}).get(column)
+            if cell == None:
+                line += "-".rjust(12)
+            else:
+                line += ("%.1f" % (100.0 * cell["wins"] / cell["games"])).rjust(12)
+        print line
+
+"""
+Write one row per game to a CSV file.
+"""
+def write_csv(path, results, numPlayers):
+    f = open(path, "wb")
+    writer = csv.writer(f)
+    header = ["game", "seed", "moves", "seconds", "winners", "error"]
+    for seat in range(1, numPlayers + 1):
+        header += ["tier" + str(seat), "think" + str(seat), "turns" + str(seat)]
+    writer.writerow(header)
+    for result in results:
+        row = [result["game"], result["seed"], result["moves"],
+                "%.3f" % result["seconds"],
+                " ".join(str(w) for w in result["winners"]), result["error"] or ""]
+        for seat in range(numPlayers):
+            row += [tier_names[result["tiers"][seat]],
+                    "%.4f" % result["think"][seat], result["turns"][seat]]
+        writer.writerow(row)
+    f.close()
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description = "Play AI difficulty levels against each other.")
+    parser.add_argument("--games", type = int, default = 10,
+            help = "games for every seating of every pairing (default 10)")
+    parser.add_argument("--players", type = int, default = 2, choices = [2, 3])
+    parser.add_argument("--tiers", default = "0123",
+            help = "difficulty levels to include, e.g. 0123 (default)")
+    parser.add_argument("--seed", type = int, default = 0,
+            help = "seed of the first game; each game adds its number to it")
+    parser.add_argument("--max-moves", type = int, default = 1000,
+            help = "turns before a game is called unfinished")
+    parser.add_argument("--max-time", type = float, default = 1.0,
+            help = "seconds a searching AI may think per move")
+    parser.add_argument("--processes", type = int, default = cpu_count())
+    parser.add_argument("--json", help = "file to write all results to")
+    parser.add_argument("--csv", help = "file to write one row per game to")
+    args = parser.parse_args()
+    try:
+        tiers = [int(c) for c in args.tiers]
+    except ValueError:
+        print "Tiers must be digits, e.g. 0123."
+        sys.exit(1)
+    if len(tiers) < args.players or not all(0 <= t < len(tier_names) for t in tiers):
+        print "Need at least", args.players, "tiers between 0 and", len(tier_names) - 1
+        sys.exit(1)
+    jobs = make_jobs(tiers, args.players, args.games, args.seed,
+            args.max_moves, args.max_time)
+    print "Playing", len(jobs), "games on", args.processes, "processes"
+    pool = Pool(args.processes)
+    results = []
+    start = time()
+    try:
+        # One game per task, so long games don't hold up a whole batch
+        for result in pool.imap_unordered(play_game, jobs):
+            results.append(result)
+            sys.stdout.write("\r%d/%d" % (len(results), len(jobs)))
+            sys.stdout.flush()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        print "\nStopped early"
+    pool.join()
+    print "\rPlayed", len(results), "games in %.1f seconds\n" % (time() - start)
+    results.sort(key = lambda result: result["game"])
+    summary = summarise(results)
+    print_summary(summary)
+    if args.json:
+        f = open(args.json, "w")
+        json.dump({"settings": vars(args), "summary": summary, "games": results},
+                f, indent = 1)
+        f.close()
+    if args.csv:
+        write_csv(args.csv, results, args.players)